@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Build a single bowtie2 index out of several of the per-reference
+indexes in bt2/, for use with run.py's COMBINED_INDEX mode.
+
+Sequence names in the combined index are prefixed with the name of
+the reference they came from (e.g. `hhv6a|NC_001664.4`) so that
+alignments can be sent back to the right per-reference output. The
+references are listed, one per line, in bt2/<output>.references, which
+sra_pipeline checks -y against when submitting with -x.
+"""
+
+import argparse
+import os
+import sys
+
+import sh
+
+REF_SEP = "|"
+
+
+def write_combined_fasta(references, bt2_dir, fasta):
+    "recover each reference's sequences from its index and write them to fasta"
+    with open(fasta, "w") as fileh:
+        for reference in references:
+            print("extracting {}...".format(reference))
+            for line in sh.bowtie2_inspect(
+                os.path.join(bt2_dir, reference), _iter=True
+            ):
+                if line.startswith(">"):
+                    line = ">{}{}{}".format(reference, REF_SEP, line[1:])
+                fileh.write(line)
+
+
+def main():
+    "do the work"
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "references", help="comma-separated list of references to combine"
+    )
+    parser.add_argument(
+        "-o", "--output", required=True, help="name of the combined index"
+    )
+    parser.add_argument(
+        "-d", "--bt2-dir", default="bt2", help="directory containing the indexes"
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=os.cpu_count(),
+        type=int,
+        help="bowtie2-build threads",
+    )
+    args = parser.parse_args()
+
+    references = [x.strip() for x in args.references.split(",")]
+    bad = [x for x in references if REF_SEP in x]
+    if bad:
+        print("reference names can't contain '{}': {}".format(REF_SEP, bad))
+        sys.exit(1)
+    fasta = os.path.join(args.bt2_dir, "{}.fa".format(args.output))
+    write_combined_fasta(references, args.bt2_dir, fasta)
+    print("building {}...".format(args.output))
+    for line in sh.bowtie2_build(
+        "--threads",
+        args.threads,
+        fasta,
+        os.path.join(args.bt2_dir, args.output),
+        _iter=True,
+        _err_to_out=True,
+    ):
+        sys.stdout.write(line)
+    os.remove(fasta)
+    with open(
+        os.path.join(args.bt2_dir, "{}.references".format(args.output)), "w"
+    ) as fileh:
+        fileh.write("".join("{}\n".format(x) for x in references))
+    print("done, submit with -y {} -x {}".format(",".join(references), args.output))
+
+
+if __name__ == "__main__":
+    main()
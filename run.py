@@ -2,16 +2,24 @@
 
 "script to run on AWS batch instance"
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import datetime
 from functools import partial
 import glob
+import hashlib
 import json
 import os
 import os.path
 from pathlib import Path
 import random
+import re
+import shlex
+import shutil
+import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -20,6 +28,15 @@ import requests
 
 HOME = os.getenv("HOME")
 PTMP = "tmp"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+REF_SEP = "|"  # separates reference and sequence names in a combined index
+TIMINGS = {}  # stage -> seconds, see record_timing()
+DUP_SEP = (
+    "__x"  # separates a read name from its number of copies, see collapse_duplicates()
+)
+SHARD_SEP = "#"  # separates accession and shard in a manifest line, see main()
+READ_COUNTS = {}  # fastq -> number of reads, see count_reads()
+FASTQ_SCRATCH_FACTOR = 40  # .sra sizes of scratch, see check_scratch()
 
 
 class Timer:  # pylint: disable=too-few-public-methods
@@ -130,26 +147,31 @@ def get_fastq_files_from_s3(sra_accession):
     """
     If fastq files are present in S3, download them and return True.
     Otherwise return False.
+    A cache in BGZF format (with .gzi block indexes, see convert_to_bgzf())
+    is preferred over one in plain gzip.
     """
     bucket = os.getenv("BUCKET_NAME")
     dirs = ["pipeline-fastq", "pipeline-fastq-salivary"]
-    found_one = False
-    found_two = False
+    found = []
     for dir_ in dirs:
-        for num in ["1", "2"]:
-            key = "{}/{}/{}_{}.fastq.gz".format(dir_, sra_accession, sra_accession, num)
-            if object_exists_in_s3(key):
-                fprint("Downloading {}_{}.fastq.gz....".format(sra_accession, num))
-                sh.aws("s3", "cp", "s3://{}/{}".format(bucket, key), ".")
-                # false positive below:
-                # https://github.com/PyCQA/pylint/issues/837#issuecomment-255109936
-                if num == "1":  # pylint: disable=simplifiable-if-statement
-                    found_one = True
-                else:
-                    found_two = True
-        if found_one and found_two:
-            return True
-    return False
+        keys = [
+            "{}/{}/{}_{}.fastq.gz".format(dir_, sra_accession, sra_accession, num)
+            for num in ["1", "2"]
+        ]
+        if all(object_exists_in_s3(x) for x in keys):
+            if all(object_exists_in_s3("{}.gzi".format(x)) for x in keys):
+                keys.extend(["{}.gzi".format(x) for x in keys])
+                found.insert(0, keys)
+            else:
+                found.append(keys)
+    if not found:
+        return False
+    with Timer() as timer:
+        for key in found[0]:
+            fprint("Downloading {}....".format(os.path.basename(key)))
+            sh.aws("s3", "cp", "s3://{}/{}".format(bucket, key), ".")
+    record_timing("fastq-cache", timer.interval)
+    return True
 
 
 def object_exists_in_s3(key):
@@ -171,6 +193,212 @@ def get_size_of_sra(sra_accession):
     fprint("size of {} is {}.".format(sra_accession, sh.prefetch("-s", sra_accession)))
 
 
+class RangedDownload:
+    """
+    Download a URL with several concurrent HTTP range requests into a
+    preallocated sparse file. Finished chunks are recorded in a resume
+    map (`dest`.parts) so that a download run again in the same place
+    continues where the previous attempt stopped.
+    """
+
+    RETRIES = 5  # per chunk
+
+    def __init__(self, url, dest, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self.url = url
+        self.dest = dest
+        self.chunk_size = chunk_size
+        self.size = None
+        self.etag = None
+        self.done = set()
+        self.lock = threading.Lock()
+
+    @property
+    def resume_file(self):
+        "path of the resume map"
+        return "{}.parts".format(self.dest)
+
+    def probe(self):
+        "find the size of the object, raise ValueError if ranges are not supported"
+        resp = requests.get(self.url, headers={"Range": "bytes=0-0"}, timeout=60)
+        resp.raise_for_status()
+        match = re.match(r"bytes 0-0/(\d+)", resp.headers.get("Content-Range", ""))
+        if resp.status_code != 206 or not match:
+            raise ValueError("server does not support range requests")
+        self.size = int(match.group(1))
+        self.etag = resp.headers.get("ETag", "").strip('"')
+
+    def load_resume_map(self):
+        "pick up finished chunks from a previous attempt, if it matches this one"
+        if not (os.path.exists(self.resume_file) and os.path.exists(self.dest)):
+            return
+        with open(self.resume_file) as filehandle:
+            resume = json.load(filehandle)
+        if (resume["size"], resume["etag"], resume["chunk_size"]) == (
+            self.size,
+            self.etag,
+            self.chunk_size,
+        ):
+            self.done = set(resume["done"])
+            fprint(
+                "resuming download, {} of {} chunks already done".format(
+                    len(self.done), self.num_chunks()
+                )
+            )
+
+    def save_resume_map(self):
+        "write the resume map atomically; call with self.lock held"
+        tmpfile = "{}.tmp".format(self.resume_file)
+        with open(tmpfile, "w") as filehandle:
+            json.dump(
+                dict(
+                    size=self.size,
+                    etag=self.etag,
+                    chunk_size=self.chunk_size,
+                    done=sorted(self.done),
+                ),
+                filehandle,
+            )
+        os.replace(tmpfile, self.resume_file)
+
+    def num_chunks(self):
+        "number of chunks the object is split into"
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def fetch_chunk(self, fd, chunk):  # pylint: disable=invalid-name
+        "download one chunk into its place in the file, retrying on failure"
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        for attempt in range(self.RETRIES + 1):
+            offset = start
+            try:
+                resp = requests.get(
+                    self.url,
+                    headers={"Range": "bytes={}-{}".format(start, end)},
+                    stream=True,
+                    timeout=60,
+                )
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise ValueError("expected partial content, got whole object")
+                for data in resp.iter_content(1024 * 1024):
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                if offset != end + 1:
+                    raise ValueError("short read")
+                break
+            except (requests.exceptions.RequestException, ValueError) as exc:
+                if attempt == self.RETRIES:
+                    raise
+                fprint(
+                    "chunk {} failed at byte {} ({}), retrying...".format(
+                        chunk, offset, exc
+                    )
+                )
+                time.sleep(2**attempt)
+        with self.lock:
+            self.done.add(chunk)
+            self.save_resume_map()
+        return end + 1 - start
+
+    def run(self, connections=8):
+        """
+        download all chunks not yet done with `connections` concurrent
+        requests, returns number of bytes downloaded
+        """
+        if self.size is None:
+            self.probe()
+        self.load_resume_map()
+        todo = [x for x in range(self.num_chunks()) if x not in self.done]
+        fd = os.open(self.dest, os.O_RDWR | os.O_CREAT)  # pylint: disable=invalid-name
+        try:
+            os.ftruncate(fd, self.size)  # sparse until the chunks arrive
+            with ThreadPoolExecutor(connections) as pool:
+                return sum(pool.map(partial(self.fetch_chunk, fd), todo))
+        finally:
+            os.close(fd)
+
+    def verify(self):
+        """
+        Check the size of the downloaded file and, if the ETag is a plain
+        MD5 (i.e. not a multipart upload), its checksum.
+        Raises ValueError on mismatch, after removing the file and resume
+        map, since resuming would only reproduce the same bad file.
+        """
+        actual = os.path.getsize(self.dest)
+        if actual != self.size:
+            self.discard()
+            raise ValueError("size is {}, expected {}".format(actual, self.size))
+        if re.match(r"^[0-9a-f]{32}$", self.etag):
+            md5 = hashlib.md5()
+            with open(self.dest, "rb") as filehandle:
+                for data in iter(partial(filehandle.read, 1024 * 1024), b""):
+                    md5.update(data)
+            if md5.hexdigest() != self.etag:
+                self.discard()
+                raise ValueError(
+                    "md5 is {}, expected {}".format(md5.hexdigest(), self.etag)
+                )
+        os.remove(self.resume_file)
+
+    def discard(self):
+        "remove the downloaded file and resume map"
+        for path in (self.dest, self.resume_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def resolve_sra_url(sra_accession):
+    "get an http(s) URL for an accession, or None if srapath can't give us one"
+    try:
+        url = sh.srapath(sra_accession).strip()
+    except sh.ErrorReturnCode:
+        return None
+    if not url.startswith("http"):
+        return None
+    return url
+
+
+def ranged_download_from_sra(sra_accession, url):
+    """
+    Download an accession with RangedDownload.
+    Returns False if the server does not support range requests.
+    """
+    sh.mkdir("-p", "sra")
+    download = RangedDownload(url, "sra/{}.sra".format(sra_accession))
+    connections = int(os.getenv("SRA_DOWNLOAD_CONNECTIONS"))
+    try:
+        download.probe()
+    except (requests.exceptions.RequestException, ValueError) as exc:
+        fprint("can't do a ranged download ({}), using prefetch".format(exc))
+        return False
+    fprint(
+        "Beginning ranged download of {} bytes with {} connections...".format(
+            download.size, connections
+        )
+    )
+    try:
+        with Timer() as timer:
+            nbytes = download.run(connections)
+        record_timing("download", timer.interval)
+        fprint(
+            "downloaded {} bytes in {} ({:.1f} MB/s)".format(
+                nbytes,
+                timer.interval,
+                nbytes / 1e6 / max(timer.interval.total_seconds(), 1e-6),
+            )
+        )
+        download.verify()
+    except (requests.exceptions.RequestException, ValueError) as exc:
+        # a failed transfer keeps the partial file and resume map (exiting
+        # here skips cleanup()), so a Batch retry of this child that lands on
+        # the same host can pick up from here; a failed verify() has already
+        # removed them
+        fprint("ranged download failed ({}), exiting...".format(exc))
+        sys.exit(1)
+    fprint("finished downloading")
+    return True
+
+
 def download_from_sra(sra_accession):
     "download from sra"
     get_size_of_sra(sra_accession)
@@ -183,37 +411,63 @@ def download_from_sra(sra_accession):
         )
         time.sleep(minutes_to_sleep * 60)
     fprint("Downloading {} from sra...".format(sra_accession))
-    if os.path.exists("{}/ncbi/dbGaP-19838/sra/{}.sra".format(HOME, sra_accession)):
+    sra_file = "{}/ncbi/dbGaP-19838/sra/{}.sra".format(HOME, sra_accession)
+    if os.path.exists(sra_file) and not os.path.exists("{}.parts".format(sra_file)):
         fprint("SRA file already exists, skipping download")
-    else:
-        # prefetch_cmd = sh.Command("/sratoolkit.2.9.2-ubuntu64/bin/prefetch")
-        prefetch = sh.prefetch(
-            "--transport",
-            "http",
-            "--max-size",
-            "100000000000",
-            sra_accession,
-            _iter=True,
-            _err_to_out=True,
-        )
-        fprint("Beginning download...")
+        return
+    if os.getenv("SRA_DOWNLOAD_CONNECTIONS"):
+        url = resolve_sra_url(sra_accession)
+        if url and ranged_download_from_sra(sra_accession, url):
+            return
+    if os.path.exists("{}.parts".format(sra_file)):
+        sh.rm("-f", sra_file, "{}.parts".format(sra_file))
+    # prefetch_cmd = sh.Command("/sratoolkit.2.9.2-ubuntu64/bin/prefetch")
+    prefetch = sh.prefetch(
+        "--transport",
+        "http",
+        "--max-size",
+        "100000000000",
+        sra_accession,
+        _iter=True,
+        _err_to_out=True,
+    )
+    fprint("Beginning download...")
+    with Timer() as timer:
         for line in prefetch:
             fprint(line)
-        prefetch_exit_code = prefetch.exit_code
-        if prefetch_exit_code != 0:
-            fprint(
-                "prefetch exited with nonzero result-code {}, cleaning up and exiting...".format(
-                    prefetch_exit_code
-                )
+    record_timing("download", timer.interval)
+    prefetch_exit_code = prefetch.exit_code
+    if prefetch_exit_code != 0:
+        fprint(
+            "prefetch exited with nonzero result-code {}, cleaning up and exiting...".format(
+                prefetch_exit_code
             )
-            sh.rm("-rf", "{}/ncbi/dbGaP-19838/sra/{}.sra".format(HOME, sra_accession))
-            for item in ["sra", "refseq"]:
-                clean_directory("{}/ncbi/public/{}".format(HOME, item))
-            sys.exit(prefetch_exit_code)
+        )
+        sh.rm("-rf", "{}/ncbi/dbGaP-19838/sra/{}.sra".format(HOME, sra_accession))
+        for item in ["sra", "refseq"]:
+            clean_directory("{}/ncbi/public/{}".format(HOME, item))
+        sys.exit(prefetch_exit_code)
+
+
+def check_scratch(sra_accession):
+    """
+    Warn if scratch looks too small for fastq-dump. Its uncompressed
+    output can be over 20 times the size of the .sra, and while
+    parallel-fastq-dump joins its chunks that output is on scratch twice.
+    """
+    needed = FASTQ_SCRATCH_FACTOR * os.path.getsize("sra/{}.sra".format(sra_accession))
+    free = shutil.disk_usage(".").free
+    if free < needed:
+        fprint(
+            "warning: {:.1f} GB of scratch is free, fastq-dump may need {:.1f} GB".format(
+                free / 1e9, needed / 1e9
+            )
+        )
 
 
 def run_fastq_dump(sra_accession):
     "run fastq-dump"
+    check_scratch(sra_accession)
     fprint("running fastq-dump...")
 
     # pfd0 = sh.Command("/home/neo/miniconda3/bin/parallel-fastq-dump")
@@ -221,8 +475,7 @@ def run_fastq_dump(sra_accession):
         "--sra-id",
         "sra/{}.sra".format(sra_accession),
         "--threads",
-        os.getenv("NUM_CORES"),
-        "--gzip",
+        SCHEDULER.threads("fastq-dump"),
         "--split-files",
         "-W",
         "-I",
@@ -236,19 +489,679 @@ def run_fastq_dump(sra_accession):
             fprint(line)
 
     fprint("duration of fastq-dump: {}".format(timer.interval))
+    record_timing("fastq-dump", timer.interval)
+    convert_to_bgzf(sra_accession)
 
 
-def copy_fastqs_to_s3(sra_accession):
-    "copy fastqs to s3"
-    for i in range(1, 3):
-        sh.aws(
+def convert_to_bgzf(sra_accession):
+    """
+    Compress the fastqs written by fastq-dump as BGZF. This is still
+    gzip (so bowtie2 etc. read it as before) but is made of
+    independently compressed blocks, and the .gzi block index written
+    next to each file lets later passes decompress it with several
+    threads (see fastq_inputs()). bgzip replaces each .fastq with a
+    .fastq.gz and writes its index to .fastq.gz.gzi.
+    """
+    fprint("compressing fastqs as BGZF...")
+    with Timer() as timer:
+        for i in range(1, 3):
+            sh.bgzip(
+                "-@",
+                SCHEDULER.threads("bgzip"),
+                "-i",
+                "-f",
+                "{}_{}.fastq".format(sra_accession, i),
+            )
+    fprint("duration of BGZF compression: {}".format(timer.interval))
+    record_timing("bgzf", timer.interval)
+
+
+def configure_fastq_upload():
+    """
+    The fastq cache upload runs alongside bowtie2, so it gets its own
+    aws cli config with a bandwidth cap (FASTQ_UPLOAD_BANDWIDTH, default
+    100MB/s) to leave room for the bowtie2 output streams.
+    Returns the environment to run the upload with.
+    """
+    config_file = os.path.abspath("fastq-upload.config")
+    default_config = "{}/.aws/config".format(HOME)
+    if os.path.exists(default_config):
+        sh.cp(default_config, config_file)
+    env = os.environ.copy()
+    env["AWS_CONFIG_FILE"] = config_file
+    params = {
+        "default.s3.multipart_chunksize": "64MB",
+        "default.s3.max_concurrent_requests": "20",
+        "default.s3.multipart_threshold": "64MB",
+        "default.s3.max_bandwidth": os.getenv("FASTQ_UPLOAD_BANDWIDTH", "100MB/s"),
+    }
+    for key, value in params.items():
+        sh.aws("configure", "set", key, value, _env=env)
+    return env
+
+
+def start_fastq_upload(sra_accession):
+    """
+    start copying fastqs to s3 in the background,
+    returns the running command (pass it to finish_fastq_upload())
+    """
+    env = configure_fastq_upload()
+    fprint("copying fastqs to s3 in the background...")
+    upload = sh.aws(
+        "s3",
+        "cp",
+        ".",
+        "s3://{}/pipeline-fastq/{}/".format(os.getenv("BUCKET_NAME"), sra_accession),
+        "--recursive",
+        "--exclude",
+        "*",
+        "--include",
+        "{}_1.fastq.gz".format(sra_accession),
+        "--include",
+        "{}_2.fastq.gz".format(sra_accession),
+        "--include",
+        "{}_?.fastq.gz.gzi".format(sra_accession),
+        "--only-show-errors",
+        _env=env,
+        _bg=True,
+        _bg_exc=False,
+    )
+    SCHEDULER.watch_background("upload", upload.pid)
+    return upload
+
+
+def finish_fastq_upload(upload, sra_accession):
+    """
+    Wait for a background fastq upload to finish.
+    A failed upload only costs us the cache, so it is logged and
+    cleaned up but does not fail the job.
+    """
+    if upload is None:
+        return
+    fprint("waiting for fastq upload to finish...")
+    try:
+        with Timer() as timer:
+            upload.wait()
+        fprint("duration of fastq upload: {}".format(timer.interval))
+        record_timing("fastq-upload", timer.interval)
+    except sh.ErrorReturnCode as exc:
+        fprint("fastq upload failed, removing partial cache:")
+        fprint(exc.stderr.decode("utf-8", "replace"))
+        try:
+            sh.aws(
+                "s3",
+                "rm",
+                "s3://{}/pipeline-fastq/{}/".format(
+                    os.getenv("BUCKET_NAME"), sra_accession
+                ),
+                "--recursive",
+            )
+        except sh.ErrorReturnCode:
+            fprint("could not remove partial fastq cache")
+
+
+def current_shard():
+    """
+    (index, count) of the read range this child aligns, from SHARD
+    (set by main() from a manifest line like SRR123#2/8), or None
+    """
+    if not os.getenv("SHARD"):
+        return None
+    index, count = os.getenv("SHARD").split("/")
+    return int(index), int(count)
+
+
+def shard_key(sra_accession, index, name):
+    "S3 key of one shard's copy of an output file, see merge_shards()"
+    return "{}-shards/{}/{}/{}".format(os.getenv("PREFIX"), sra_accession, index, name)
+
+
+def get_references():
+    "references to align against, from the REFERENCES environment variable"
+    return [x.strip() for x in os.getenv("REFERENCES").split(",")]
+
+
+def output_key(sra_accession, virus):
+    "S3 key of the output sam file for an accession and reference"
+    shard = current_shard()
+    if shard:
+        return shard_key(sra_accession, shard[0], "{}.sam".format(virus))
+    return "{}/{}/{}/{}.sam".format(
+        os.getenv("PREFIX"), sra_accession, virus, sra_accession
+    )
+
+
+def bowtie_input_args(sra_accession, read_handling):
+    "bowtie2 arguments naming the input fastq file(s), see run_bowtie()"
+    if read_handling == "equal":
+        return [
+            "-1",
+            "{}_1.fastq.gz".format(sra_accession),
+            "-2",
+            "{}_2.fastq.gz".format(sra_accession),
+        ]
+    if read_handling in (1, 2):
+        return ["-U", "{}_{}.fastq.gz".format(sra_accession, read_handling)]
+    return []
+
+
+class CoreScheduler:
+    """
+    Owns the NUM_CORES budget and decides how many threads each stage
+    gets. fastq-dump and BGZF compression run on their own; during
+    alignment the BGZF decoders, bowtie2, a background fastq upload and
+    (when it post-processes bowtie2 output) this script share the cores.
+    While an alignment runs, the CPU time of each stage's processes is
+    sampled from /proc. Between alignments, threads are moved between
+    the decoders and bowtie2: decoders that are mostly idle are blocked
+    on full pipes (bowtie2 can't keep up), decoders that are saturated
+    while bowtie2 is not are starving it. Decisions are logged and
+    included in the timing record (see upload_timings()).
+    """
+
+    SAMPLE_SECONDS = 5
+    MIN_SECONDS = 60  # shorter alignments are logged but don't rebalance
+    SATURATED = 0.85  # fraction of its threads a stage keeps busy
+    IDLE = 0.5
+
+    def __init__(self):
+        self.decode = None  # threads per BGZF decoder
+        self.bowtie = None  # threads last given to bowtie2
+        self.watched = defaultdict(set)  # stage -> pids, for the current alignment
+        self.background = {}  # stage -> pid, for work that outlives an alignment
+        self.cpu = {}  # pid -> [stage, cpu seconds at first sample, at last sample]
+        self.decisions = []
+
+    @property
+    def cores(self):
+        "the budget"
+        return int(os.getenv("NUM_CORES"))
+
+    def supervised(self):
+        "whether this script reads bowtie2's output, costing about a core"
+        return bool(os.getenv("COMBINED_INDEX") or os.getenv("COLLAPSE_DUPLICATES"))
+
+    def threads(self, stage):
+        "threads to give a stage starting now"
+        if stage in ("fastq-dump", "bgzip", "collapse"):
+            return self.cores
+        if stage == "decode":
+            if self.decode is None:
+                self.decode = max(1, self.cores // 4)
+            return self.decode
+        decoders = len(self.watched["decode"])
+        upload = int(
+            "upload" in self.background and process_alive(self.background["upload"])
+        )
+        supervisor = int(self.supervised())
+        self.bowtie = max(
+            1, self.cores - decoders * self.threads("decode") - upload - supervisor
+        )
+        fprint(
+            "scheduler: bowtie2 gets {} of {} cores "
+            "(decoders {}x{}, upload {}, supervisor {})".format(
+                self.bowtie, self.cores, decoders, self.decode, upload, supervisor
+            )
+        )
+        return self.bowtie
+
+    def watch(self, stage, pid):
+        "account the CPU time of a process (and its children) to a stage"
+        self.watched[stage].add(pid)
+
+    def watch_background(self, stage, pid):
+        "like watch(), for a process that runs across several alignments"
+        self.background[stage] = pid
+
+    def sample(self, first=False):
+        "record the CPU time of watched processes, return (time, host busy, total)"
+        procs = read_processes()
+        children = defaultdict(list)
+        for pid, (ppid, _, _) in procs.items():
+            children[ppid].append(pid)
+        roots = [(x, y) for x, pids in self.watched.items() for y in pids]
+        roots.extend(self.background.items())
+        for stage, root in roots:
+            tree = [root]
+            while tree:
+                pid = tree.pop()
+                tree.extend(children[pid])
+                if pid not in procs:
+                    continue
+                if pid not in self.cpu:
+                    # processes seen after the first sample started after us
+                    self.cpu[pid] = [stage, procs[pid][2] if first else 0.0, 0.0]
+                self.cpu[pid][2] = procs[pid][2]
+        return (time.time(),) + read_host_cpu()
+
+    @contextlib.contextmanager
+    def monitor(self, label):
+        """
+        sample the stages while an alignment runs, then rebalance();
+        enter it after starting the decoders (see fastq_inputs())
+        """
+        self.cpu.clear()
+        samples = [self.sample(first=True)]
+        stop = threading.Event()
+
+        def sampler():
+            "sample until stopped"
+            while not stop.wait(self.SAMPLE_SECONDS):
+                samples.append(self.sample())
+
+        thread = threading.Thread(target=sampler, daemon=True)
+        thread.start()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            stop.set()
+            thread.join()
+            if succeeded:
+                samples.append(self.sample())
+                self.rebalance(label, samples)
+            self.watched.clear()
+
+    def rebalance(self, label, samples):
+        "adjust the decoder threads from what the stages did during an alignment"
+        wall = samples[-1][0] - samples[0][0]
+        if wall <= 0 or self.bowtie is None:
+            return
+        used = defaultdict(float)
+        for stage, start, end in self.cpu.values():
+            used[stage] += max(end - start, 0.0) / wall
+        host_total = samples[-1][2] - samples[0][2]
+        host_busy = (samples[-1][1] - samples[0][1]) / host_total if host_total else 0
+        decoders = len(self.watched["decode"])
+        decision = dict(
+            stage=label,
+            seconds=round(wall, 1),
+            cores=self.cores,
+            host_busy=round(host_busy, 3),
+            decoders=decoders,
+            decode_threads=self.decode,
+            bowtie2_threads=self.bowtie,
+            cpus_used={x: round(y, 2) for x, y in used.items()},
+        )
+        change = "unchanged"
+        if decoders and wall >= self.MIN_SECONDS:
+            decode_load = used["decode"] / (decoders * self.decode)
+            bowtie_load = used["bowtie2"] / self.bowtie
+            if (
+                decode_load > self.SATURATED
+                and bowtie_load < self.SATURATED
+                and self.bowtie > decoders
+            ):
+                self.decode += 1
+                change = "decoders saturated while bowtie2 waits, decode threads +1"
+            elif decode_load < self.IDLE and self.decode > 1:
+                self.decode -= 1
+                change = "decoders blocked on full pipes, decode threads -1"
+        decision["change"] = change
+        self.decisions.append(decision)
+        fprint(
+            "scheduler: {} took {:.0f}s, host {:.0%} busy, cpus used {}; {}".format(
+                label, wall, host_busy, decision["cpus_used"], change
+            )
+        )
+
+
+def read_processes():
+    "pid -> (parent pid, state, cpu seconds) for every process, from /proc"
+    procs = {}
+    ticks = os.sysconf("SC_CLK_TCK")
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as fileh:
+                stat = fileh.read()
+        except OSError:
+            continue
+        fields = stat.rsplit(")", 1)[1].split()
+        procs[int(entry)] = (
+            int(fields[1]),
+            fields[0],
+            (int(fields[11]) + int(fields[12])) / ticks,
+        )
+    return procs
+
+
+def read_host_cpu():
+    "(busy, total) cpu time of the host in ticks, from /proc/stat"
+    with open("/proc/stat") as fileh:
+        ticks = [int(x) for x in fileh.readline().split()[1:]]
+    idle = ticks[3] + ticks[4]  # idle + iowait
+    return sum(ticks) - idle, sum(ticks)
+
+
+def process_alive(pid):
+    "whether a process is running (and not a zombie)"
+    try:
+        with open("/proc/{}/stat".format(pid)) as fileh:
+            return fileh.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+SCHEDULER = CoreScheduler()
+
+
+def decode_threads():
+    "threads to give each BGZF decompressor"
+    return SCHEDULER.threads("decode")
+
+
+def decompress_args(filename):
+    "command line that writes a cached fastq to stdout, multithreaded if it's BGZF"
+    if os.path.exists("{}.gzi".format(filename)):
+        return ["bgzip", "-dc", "-@", str(decode_threads()), filename]
+    return ["gzip", "-dc", filename]
+
+
+def decompress(filename):
+    "start decompressing a cached fastq, to be piped into another sh command"
+    args = decompress_args(filename)
+    return sh.Command(args[0])(*args[1:], _piped=True)
+
+
+@contextlib.contextmanager
+def fastq_inputs(sra_accession, read_handling):
+    """
+    Yield the bowtie2 arguments naming the input fastqs (see
+    bowtie_input_args()). BGZF fastqs are decompressed with several
+    threads into named pipes, which bowtie2 reads instead of the files.
+    """
+    args = bowtie_input_args(sra_accession, read_handling)
+    if os.getenv("COLLAPSE_DUPLICATES"):
+        args = collapsed_input_args(args)
+    args = args + shard_args(args)
+    decoders = []
+    fifos = []
+    try:
+        for i, arg in enumerate(args):
+            if not os.path.exists("{}.gzi".format(arg)):
+                continue
+            fifo = "{}.fifo".format(arg[: -len(".gz")])
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            fifos.append(fifo)
+            decoders.append(
+                subprocess.Popen(
+                    "exec {} > {}".format(
+                        " ".join(shlex.quote(x) for x in decompress_args(arg)),
+                        shlex.quote(fifo),
+                    ),
+                    shell=True,
+                )
+            )
+            SCHEDULER.watch("decode", decoders[-1].pid)
+            args[i] = fifo
+        yield args
+    finally:
+        for proc in decoders:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        for fifo in fifos:
+            os.remove(fifo)
+
+
+def count_reads(filename):
+    "number of reads in a cached fastq, counted once per file"
+    if filename not in READ_COUNTS:
+        READ_COUNTS[filename] = int(
+            sh.awk(decompress(filename), "{s++}END{print s/4}").strip()
+        )
+    return READ_COUNTS[filename]
+
+
+def shard_args(args):
+    """
+    bowtie2 arguments restricting a list of input arguments to this
+    child's read range, if it aligns a shard (see current_shard())
+    """
+    shard = current_shard()
+    if not shard:
+        return []
+    index, count = shard
+    reads = count_reads([x for x in args if x.endswith(".fastq.gz")][0])
+    per_shard = -(-reads // count)
+    fprint(
+        "aligning shard {} of {}: reads {} to {} of {}".format(
+            index + 1,
+            count,
+            index * per_shard,
+            min((index + 1) * per_shard, reads),
+            reads,
+        )
+    )
+    return ["-s", str(index * per_shard), "-u", str(per_shard)]
+
+
+# groups the reads sorted by collapse_duplicates(), one per tab-separated
+# line (name, sequence, + line and quality of each mate in turn), and
+# writes the first read of each group to /dev/fd/3 (and its mate to
+# /dev/fd/4), adding DUP_SEP and the number of copies to its name if
+# there was more than one; prints the number of reads and of groups
+COLLAPSE_AWK = r"""
+$1 == "" || (mates == 2 && $5 == "") { uneven = 1; exit 3 }
+{
+    key = mates == 2 ? $2 "\t" $6 : $2
+    if (NR > 1 && key == last) {
+        count++
+        next
+    }
+    if (NR > 1)
+        emit()
+    last = key
+    first = $0
+    count = 1
+}
+END {
+    if (uneven)
+        exit 3
+    if (NR)
+        emit()
+    printf "%d %d\n", NR, unique
+}
+function emit(    fields, i, name, space) {
+    unique++
+    split(first, fields, "\t")
+    for (i = 0; i < mates; i++) {
+        name = fields[i * 4 + 1]
+        if (count > 1) {
+            space = index(name, " ")
+            if (space)
+                name = substr(name, 1, space - 1) sep count substr(name, space)
+            else
+                name = name sep count
+        }
+        printf "%s\n%s\n+\n%s\n", name, fields[i * 4 + 2], fields[i * 4 + 4] \
+            > ("/dev/fd/" (i + 3))
+    }
+}
+"""
+
+
+# decompresses, sorts and groups the reads for collapse_duplicates(), with
+# one bgzip process per output reading from a named pipe
+COLLAPSE_SCRIPT = """
+set -o pipefail
+compressors=()
+{compressors}
+paste {decoders} \\
+    | LC_ALL=C sort -s -t "$(printf '\\t')" {keys} -S {memory}M \\
+        --parallel={threads} -T {tmp} \\
+    | awk -F '\\t' -v mates={mates} -v sep={sep} {program} {redirects}
+status=$?
+for pid in "${{compressors[@]}}"; do
+    wait $pid || status=1
+done
+exit $status
+"""
+
+
+def collapse_duplicates(inputs, outputs):
+    """
+    Collapse exact duplicate reads from the fastq files `inputs` into
+    BGZF `outputs` (with .gzi indexes). With two inputs, reads are pairs
+    and both mates must match. The first copy of each read is kept and,
+    if there was more than one, DUP_SEP and the number of copies are
+    appended to its name (see expand_duplicates()). Duplicates are
+    brought together by a stable GNU sort on the sequences, which uses
+    DEDUP_MEMORY_MB (default 4096) of memory and spills the rest to PTMP.
+    Returns (reads, unique reads), or None if paired inputs have
+    different numbers of reads.
+    """
+    threads = SCHEDULER.threads("collapse")
+    fifos = [
+        os.path.join(PTMP, "collapse.{}.fifo".format(x)) for x in range(len(outputs))
+    ]
+    statuses = [
+        os.path.join(PTMP, "collapse.{}.status".format(x)) for x in range(len(inputs))
+    ]
+    script = COLLAPSE_SCRIPT.format(
+        compressors="\n".join(
+            "bgzip -@ {} -c -i -I {} < {} > {} &\ncompressors+=($!)".format(
+                max(1, threads // len(outputs)),
+                shlex.quote("{}.gzi".format(output)),
+                shlex.quote(fifo),
+                shlex.quote(output),
+            )
+            for fifo, output in zip(fifos, outputs)
+        ),
+        decoders=" ".join(
+            "<({} | paste - - - -; echo ${{PIPESTATUS[0]}} > {})".format(
+                " ".join(shlex.quote(x) for x in decompress_args(x)),
+                shlex.quote(status),
+            )
+            for x, status in zip(inputs, statuses)
+        ),
+        keys=" ".join("-k{0},{0}".format(4 * x + 2) for x in range(len(inputs))),
+        memory=int(os.getenv("DEDUP_MEMORY_MB", "4096")),
+        threads=threads,
+        tmp=shlex.quote(PTMP),
+        mates=len(inputs),
+        sep=shlex.quote(DUP_SEP),
+        program=shlex.quote(COLLAPSE_AWK),
+        redirects=" ".join(
+            "{}>{}".format(x + 3, shlex.quote(y)) for x, y in enumerate(fifos)
+        ),
+    )
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+    try:
+        proc = subprocess.run(["bash", "-c", script], stdout=subprocess.PIPE)
+        # a decoder that fails looks like a short input to the rest of the
+        # pipeline, so its exit status is checked separately
+        decoded = []
+        for status in statuses:
+            if os.path.exists(status):
+                with open(status) as filehandle:
+                    decoded.append(filehandle.read().strip() == "0")
+                os.remove(status)
+    finally:
+        for fifo in fifos:
+            os.remove(fifo)
+    if proc.returncode or len(decoded) < len(inputs) or not all(decoded):
+        for path in outputs + ["{}.gzi".format(x) for x in outputs]:
+            if os.path.exists(path):
+                os.remove(path)
+        if proc.returncode == 3 and all(decoded):
+            return None
+        raise RuntimeError("collapsing duplicates failed")
+    reads, unique = proc.stdout.decode().split()
+    return int(reads), int(unique)
+
+
+def collapsed_input_args(args):
+    """
+    Replace the fastqs in a list of bowtie2 input arguments with
+    duplicate-collapsed copies, creating them if necessary.
+    """
+    inputs = [x for x in args if x.endswith(".fastq.gz")]
+    suffix = ".collapsed-pe.fastq.gz" if len(inputs) == 2 else ".collapsed.fastq.gz"
+    outputs = [x[: -len(".fastq.gz")] + suffix for x in inputs]
+    if not all(os.path.exists(x) for x in outputs):
+        fprint("collapsing duplicate reads...")
+        with Timer() as timer:
+            result = collapse_duplicates(inputs, [x + ".tmp" for x in outputs])
+        if result is None:
+            fprint("mates have different numbers of reads, not collapsing")
+            return args
+        for output in outputs:
+            os.replace(output + ".tmp", output)
+            os.replace(output + ".tmp.gzi", output + ".gzi")
+        fprint(
+            "collapsed {} reads into {} ({:.1f}% duplicates) in {}".format(
+                result[0],
+                result[1],
+                100.0 * (result[0] - result[1]) / max(result[0], 1),
+                timer.interval,
+            )
+        )
+        record_timing("collapse", timer.interval)
+    return [outputs[inputs.index(x)] if x in inputs else x for x in args]
+
+
+def multiplicity(name):
+    "split a read name from collapse_duplicates() into (name, number of copies)"
+    base, sep, count = name.rpartition(DUP_SEP)
+    if not sep or not count.isdigit():
+        return name, 1
+    return base, int(count)
+
+
+def expand_duplicates(line):
+    """
+    Undo collapse_duplicates() for one tab-separated line that starts with
+    a read name (a SAM record, say): the line is repeated once per copy,
+    named <name>, <name>:dup1, <name>:dup2 ...
+    Header lines are returned unchanged.
+    """
+    if line.startswith("@"):
+        return line
+    name, _, rest = line.partition("\t")
+    base, count = multiplicity(name)
+    if count == 1:
+        return line
+    names = [base] + ["{}:dup{}".format(base, x) for x in range(1, count)]
+    return "".join("{}\t{}".format(x, rest) for x in names)
+
+
+def align_to_s3(bowtie_args, key):
+    """
+    run bowtie2 and stream its output to an S3 key, expanding
+    collapsed duplicates if COLLAPSE_DUPLICATES is set
+    """
+    if not os.getenv("COLLAPSE_DUPLICATES"):
+        bowtie = sh.bowtie2(*bowtie_args, _piped=True, _bg_exc=False)
+        SCHEDULER.watch("bowtie2", bowtie.pid)
+        for line in sh.aws(
+            bowtie,
             "s3",
             "cp",
-            "{}_{}.fastq.gz".format(sra_accession, i),
-            "s3://{}/pipeline-fastq/{}/".format(
-                os.getenv("BUCKET_NAME"), sra_accession
-            ),
-        )
+            "-",
+            "s3://{}/{}".format(os.getenv("BUCKET_NAME"), key),
+            _iter=True,
+        ):
+            fprint(line)
+        return
+    proc = stream_to_s3(key)
+    succeeded = False
+    try:
+        bowtie = sh.bowtie2(*bowtie_args, _iter=True)
+        SCHEDULER.watch("bowtie2", bowtie.pid)
+        for line in bowtie:
+            proc.stdin.write(expand_duplicates(line).encode())
+        succeeded = True
+    finally:
+        close_streams({key: proc}, succeeded)
 
 
 def run_bowtie(sra_accession, read_handling="equal"):
@@ -260,78 +1173,609 @@ def run_bowtie(sra_accession, read_handling="equal"):
                     then both fastq files are used. If value is
                     1 or 2, then the given single fastq file is used.
     """
-    viruses = os.getenv("REFERENCES").split(",")
-    viruses = [x.strip() for x in viruses]
+    viruses = get_references()
     # cmd = sh.Command("/bowtie2-2.3.4.1-linux-x86_64//bowtie2")
-    bowtie2 = partial(sh.bowtie2, _piped=True, _bg_exc=False)
 
     for virus in viruses:
-        bowtie_args = [
-            "--local",
-            "-p",
-            os.getenv("NUM_CORES"),
-            "--no-unal",
-            "-x",
-            "/bt2/{}".format(virus),
-        ]
-        if read_handling == "equal":
-            bowtie_args.extend(
-                [
-                    "-1",
-                    "{}_1.fastq.gz".format(sra_accession),
-                    "-2",
-                    "{}_2.fastq.gz".format(sra_accession),
-                ]
-            )
-        elif read_handling == 1:
-            bowtie_args.extend(["-U", "{}_1.fastq.gz".format(sra_accession)])
-        elif read_handling == 2:
-            bowtie_args.extend(["-U", "{}_2.fastq.gz".format(sra_accession)])
+        bowtie_args = ["--local", "--no-unal", "-x", "/bt2/{}".format(virus)]
 
         fprint("processing virus {} ...".format(virus))
-        if object_exists_in_s3(
-            "{}/{}/{}/{}.sam".format(
-                os.getenv("PREFIX"), sra_accession, virus, sra_accession
-            )
-        ):
+        if object_exists_in_s3(output_key(sra_accession, virus)):
             fprint(
                 "output sam file already exists in s3 for virus {}, skipping...".format(
                     virus
                 )
             )
         else:
-            with Timer() as timer:
-                for line in sh.aws(
-                    bowtie2(*bowtie_args),
-                    "s3",
-                    "cp",
-                    "-",
-                    "s3://{}/{}/{}/{}/{}.sam".format(
-                        os.getenv("BUCKET_NAME"),
-                        os.getenv("PREFIX"),
-                        sra_accession,
-                        virus,
-                        sra_accession,
-                    ),
-                    _iter=True,
-                ):
-                    fprint(line)
+            with fastq_inputs(
+                sra_accession, read_handling
+            ) as input_args, SCHEDULER.monitor(
+                "bowtie2:{}".format(virus)
+            ), Timer() as timer:
+                align_to_s3(
+                    ["-p", str(SCHEDULER.threads("bowtie2"))]
+                    + bowtie_args
+                    + input_args,
+                    output_key(sra_accession, virus),
+                )
             fprint("bowtie2 duration for {}: {}".format(virus, timer.interval))
+            record_timing("bowtie2:{}".format(virus), timer.interval)
+
+
+def stream_to_s3(key):
+    "start streaming to an S3 key, write to .stdin and finish with close_streams()"
+    return subprocess.Popen(
+        ["aws", "s3", "cp", "-", "s3://{}/{}".format(os.getenv("BUCKET_NAME"), key)],
+        stdin=subprocess.PIPE,
+    )
+
+
+def close_streams(streams, succeeded=True):
+    """
+    Finish uploads started with stream_to_s3(). If `succeeded` is False
+    the uploads are killed instead, so no partial output ends up in S3.
+    """
+    failed = []
+    for key, proc in streams.items():
+        if succeeded:
+            proc.stdin.close()
+            if proc.wait():
+                failed.append(key)
+        else:
+            proc.kill()
+            proc.wait()
+    if failed:
+        raise RuntimeError("upload to s3 failed for {}".format(", ".join(failed)))
+
+
+def split_reference(name):
+    "split a combined index sequence name into (reference, sequence name)"
+    if REF_SEP in name:
+        return tuple(name.split(REF_SEP, 1))
+    return None, name
+
+
+def alignment_score(fields):
+    "AS:i of a SAM record, 0 if it has none (e.g. an unaligned mate)"
+    for tag in fields[11:]:
+        if tag.startswith("AS:i:"):
+            return int(tag[5:])
+    return 0
+
+
+def reverse_complement(seq):
+    "reverse complement a read sequence"
+    return seq.translate(str.maketrans("ACGTNacgtn", "TGCANtgcan"))[::-1]
+
+
+def localize_unit(unit, reference):
+    """
+    Rewrite one alignment (a record or a pair of mate records, as lists of
+    SAM fields) from the combined index so that it looks as if it came from
+    aligning to `reference` alone: reference prefixes are stripped from
+    RNAME/RNEXT, the secondary flag is cleared, and a mate aligned to some
+    other reference becomes an unaligned mate. MAPQ is left as computed
+    against the combined index (see the README). Returns SAM lines.
+    """
+    anchor = [
+        x for x in unit if not int(x[1]) & 4 and split_reference(x[2])[0] == reference
+    ][0]
+    out = []
+    for fields in unit:
+        fields = list(fields)
+        flag = int(fields[1]) & ~0x100
+        if split_reference(fields[2])[0] == reference:
+            fields[2] = split_reference(fields[2])[1]
+            if fields[6] not in ("=", "*"):
+                if split_reference(fields[6])[0] == reference:
+                    fields[6] = split_reference(fields[6])[1]
+                else:
+                    flag = (flag | 0x8) & ~0x22
+                    fields[6:9] = ["=", fields[3], "0"]
+        else:
+            seq, qual = fields[9], fields[10]
+            if flag & 0x10:
+                seq, qual = reverse_complement(seq), qual[::-1]
+            flag = (flag | 0x4) & ~0x112
+            name, pos = split_reference(anchor[2])[1], anchor[3]
+            fields = [fields[0], "", name, pos, "0", "*", "=", pos, "0", seq, qual]
+        fields[1] = str(flag)
+        out.append("\t".join(fields))
+    return out
+
+
+def best_alignments(records):
+    """
+    Given all SAM records (as lists of fields) for one read or read pair
+    from an alignment against the combined index, return a dict of
+    reference -> (score, unit) for the best-scoring alignment to each
+    reference, where unit is the list of records making up that alignment.
+    """
+    size = 2 if int(records[0][1]) & 1 else 1
+    best = {}
+    for start in range(0, len(records), size):
+        unit = records[start : start + size]
+        scores = defaultdict(int)
+        for fields in unit:
+            if not int(fields[1]) & 4:
+                scores[split_reference(fields[2])[0]] += alignment_score(fields)
+        for reference, score in scores.items():
+            if reference not in best or score > best[reference][0]:
+                best[reference] = (score, unit)
+    return best
+
+
+def demultiplex_read(records, streams, ambiguous):
+    """
+    Send the best alignment of one read (or pair) to each reference's
+    output stream. If the read scores equally well against more than one
+    reference it is also written to the `ambiguous` stream.
+    Returns the set of references it is ambiguous between, if any.
+    """
+    best = best_alignments(records)
+    for reference, (_, unit) in best.items():
+        if reference in streams:
+            streams[reference].stdin.write(
+                "".join(
+                    expand_duplicates(x + "\n") for x in localize_unit(unit, reference)
+                ).encode()
+            )
+    if len(best) < 2:
+        return None
+    top = max(x[0] for x in best.values())
+    tied = sorted(x for x, (score, _) in best.items() if score == top)
+    if len(tied) < 2:
+        return None
+    ambiguous.stdin.write(
+        expand_duplicates(
+            "{}\t{}\t{}\n".format(records[0][0], top, ",".join(tied))
+        ).encode()
+    )
+    return tuple(tied)
+
+
+def read_key(fields):
+    """
+    The name identifying the read (or pair) a SAM record belongs to.
+    fastq-dump -I names mates <spot>.1 and <spot>.2, which bowtie2 keeps,
+    so the mate number is dropped for paired records, as is the number of
+    copies added by collapse_duplicates().
+    """
+    name = multiplicity(fields[0])[0]
+    if int(fields[1]) & 1 and name[-2:] in (".1", ".2"):
+        return name[:-2]
+    return name
+
+
+def group_records(lines):
+    """
+    Group bowtie2 SAM output: yields each header line as a string, and
+    all records of one read or pair (bowtie2 writes them together) as a
+    list of lists of fields.
+    """
+    records = []
+    for line in lines:
+        if line.startswith("@"):
+            yield line
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if records and read_key(fields) != read_key(records[0]):
+            yield records
+            records = []
+        records.append(fields)
+    if records:
+        yield records
+
+
+def demultiplex_header(line, streams):
+    """
+    send a SAM header line to the output streams it belongs to,
+    returning the reference an @SQ line belongs to (None for other lines)
+    """
+    if line.startswith("@SQ"):
+        match = re.search(r"\tSN:([^\t]+)", line)
+        reference, name = split_reference(match.group(1))
+        if reference in streams:
+            streams[reference].stdin.write(
+                line.replace(match.group(1), name, 1).encode()
+            )
+        return reference
+    for proc in streams.values():
+        proc.stdin.write(line.encode())
+    return None
+
+
+def demultiplex_output(lines, streams, ambiguous):
+    """
+    Split bowtie2 output against a combined index between `streams`
+    (reference -> stream_to_s3() process), listing tied reads in
+    `ambiguous`. Raises ValueError as soon as the header has been read
+    if the index has no sequences for one of the references. Returns a
+    dict of (tied references) -> number of reads.
+    """
+    indexed = set()
+    ambiguous_counts = defaultdict(int)
+    for item in group_records(lines):
+        if isinstance(item, str):
+            indexed.add(demultiplex_header(item, streams))
+            # @PG ends the header, so all @SQ lines have been seen
+            missing = [x for x in streams if x not in indexed]
+            if item.startswith("@PG") and missing:
+                raise ValueError(
+                    "combined index has no sequences for {}".format(", ".join(missing))
+                )
+            continue
+        tied = demultiplex_read(item, streams, ambiguous)
+        if tied:
+            ambiguous_counts[tied] += multiplicity(item[0][0])[1]
+    return ambiguous_counts
+
+
+def run_bowtie_combined(sra_accession, read_handling="equal"):
+    """
+    Align once against the combined index named by COMBINED_INDEX
+    (see combine_references.py) and split the output into the same
+    per-reference sam files run_bowtie() would produce. Reads that align
+    equally well to more than one reference (e.g. hhv6a and hhv6b) are
+    listed in {PREFIX}-ambiguous/{accession}/{accession}.tsv.
+    Arguments are as for run_bowtie().
+    """
+    viruses = [
+        x
+        for x in get_references()
+        if not object_exists_in_s3(output_key(sra_accession, x))
+    ]
+    if not viruses:
+        fprint("output sam files already exist in s3 for all references, skipping...")
+        return
+    index = os.getenv("COMBINED_INDEX")
+    bowtie_args = [
+        "--local",
+        "--no-unal",
+        "-k",
+        os.getenv("COMBINED_INDEX_K", "10"),
+        "-x",
+        "/bt2/{}".format(index),
+    ]
+    fprint("processing {} against combined index {} ...".format(viruses, index))
+    streams = {x: stream_to_s3(output_key(sra_accession, x)) for x in viruses}
+    ambiguous_key = get_ambiguous_key(sra_accession)
+    ambiguous = stream_to_s3(ambiguous_key)
+    succeeded = False
+    try:
+        with fastq_inputs(
+            sra_accession, read_handling
+        ) as input_args, SCHEDULER.monitor("bowtie2-combined"), Timer() as timer:
+            bowtie = sh.bowtie2(
+                "-p",
+                SCHEDULER.threads("bowtie2"),
+                *bowtie_args,
+                *input_args,
+                _iter=True
+            )
+            SCHEDULER.watch("bowtie2", bowtie.pid)
+            try:
+                ambiguous_counts = demultiplex_output(bowtie, streams, ambiguous)
+            except ValueError:
+                bowtie.kill()
+                raise
+        succeeded = True
+    finally:
+        close_streams(dict(streams, **{ambiguous_key: ambiguous}), succeeded)
+    fprint("bowtie2 duration for combined index {}: {}".format(index, timer.interval))
+    record_timing("bowtie2-combined", timer.interval)
+    for tied, count in sorted(ambiguous_counts.items()):
+        fprint("{} reads ambiguous between {}".format(count, ", ".join(tied)))
+
+
+def get_ambiguous_key(sra_accession):
+    "S3 key of the list of ambiguous reads written by run_bowtie_combined()"
+    shard = current_shard()
+    if shard:
+        return shard_key(sra_accession, shard[0], "ambiguous.tsv")
+    return "{}-ambiguous/{}/{}.tsv".format(
+        os.getenv("PREFIX"), sra_accession, sra_accession
+    )
 
 
 def get_read_counts(sra_accession):
     "return read counts for fastq files 1 and 2"
-    results = []
-    for i in range(1, 3):
-        result = int(
-            sh.awk(
-                sh.zcat("{}_{}.fastq.gz".format(sra_accession, i)),
-                "{s++}END{print s/4}",
-                _piped=True,
-            ).strip()
+    return tuple(
+        count_reads("{}_{}.fastq.gz".format(sra_accession, i)) for i in range(1, 3)
+    )
+
+
+def shard_read_handling(sra_accession):
+    """
+    Mates with different numbers of reads are only noticed by whichever
+    shard reaches the end of the shorter file, so shards decide up front,
+    the same way main() falls back for a whole accession, which file(s)
+    to align.
+    """
+    count1, count2 = get_read_counts(sra_accession)
+    if count2 < count1:
+        fprint("-2 file has fewer reads than -1 file, aligning -1 only")
+        return 1
+    if count1 < count2:
+        fprint("-1 file has fewer reads than -2 file, aligning -2 only")
+        return 2
+    return "equal"
+
+
+def prepared_key(sra_accession, name):
+    "S3 key of a file written by prepare_shards()"
+    return shard_key(sra_accession, "prepared", name)
+
+
+def prepare_shards(sra_accession):
+    """
+    Do once, before the shards of an accession are aligned, the work each
+    of them would otherwise repeat: count the reads in the cached fastqs,
+    which also decides what to align (see shard_read_handling()), and if
+    COLLAPSE_DUPLICATES is set, collapse the duplicates in what will be
+    aligned. The counts and collapsed fastqs are uploaded for
+    fetch_prepared().
+    """
+    if not get_fastq_files_from_s3(sra_accession):
+        fprint("fastqs for {} are not cached, can't shard it".format(sra_accession))
+        sys.exit(1)
+    prepared = dict(reads=get_read_counts(sra_accession))
+    fprint("read counts: {}".format(prepared["reads"]))
+    bucket = os.getenv("BUCKET_NAME")
+    if os.getenv("COLLAPSE_DUPLICATES"):
+        args = bowtie_input_args(sra_accession, shard_read_handling(sra_accession))
+        inputs = [
+            x
+            for x in collapsed_input_args(args)
+            if x.endswith(".fastq.gz") and x not in args
+        ]
+        # mates are collapsed together, so they have the same number of reads
+        prepared["inputs"] = {x: count_reads(inputs[0]) for x in inputs}
+        for name in inputs + ["{}.gzi".format(x) for x in inputs]:
+            sh.aws(
+                "s3",
+                "cp",
+                name,
+                "s3://{}/{}".format(bucket, prepared_key(sra_accession, name)),
+            )
+    sh.aws(
+        "s3",
+        "cp",
+        "-",
+        "s3://{}/{}".format(bucket, prepared_key(sra_accession, "prepared.json")),
+        _in=json.dumps(prepared),
+    )
+
+
+def fetch_prepared(sra_accession):
+    """
+    Pick up the read counts prepare_shards() uploaded, so that this shard
+    doesn't count them again, and any collapsed fastqs. Returns True if
+    there were collapsed fastqs, which are then aligned instead of the
+    cached ones. A shard resubmitted without a prepare job (or whose
+    prepare job didn't finish) counts (and collapses) the reads itself.
+    """
+    bucket = os.getenv("BUCKET_NAME")
+    try:
+        prepared = json.loads(
+            str(
+                sh.aws(
+                    "s3",
+                    "cp",
+                    "s3://{}/{}".format(
+                        bucket, prepared_key(sra_accession, "prepared.json")
+                    ),
+                    "-",
+                )
+            )
+        )
+    except sh.ErrorReturnCode:
+        fprint("no prepared read counts, this shard will count the reads")
+        return False
+    for i, count in enumerate(prepared["reads"], 1):
+        READ_COUNTS["{}_{}.fastq.gz".format(sra_accession, i)] = count
+    inputs = prepared.get("inputs", {})
+    with Timer() as timer:
+        for name in list(inputs) + ["{}.gzi".format(x) for x in inputs]:
+            fprint("Downloading {}....".format(name))
+            sh.aws(
+                "s3",
+                "cp",
+                "s3://{}/{}".format(bucket, prepared_key(sra_accession, name)),
+                ".",
+            )
+    if inputs:
+        record_timing("fastq-cache", timer.interval)
+    READ_COUNTS.update(inputs)
+    return bool(inputs)
+
+
+def upload_shard_summary(sra_accession, read_handling):
+    "record that this child's shard is aligned, for merge_shards()"
+    index, count = current_shard()
+    summary = dict(
+        accession=sra_accession,
+        shard=index,
+        shards=count,
+        reads=get_read_counts(sra_accession),
+        read_handling=read_handling,
+    )
+    sh.aws(
+        "s3",
+        "cp",
+        "-",
+        "s3://{}/{}".format(
+            os.getenv("BUCKET_NAME"), shard_key(sra_accession, index, "summary.json")
+        ),
+        _in=json.dumps(summary),
+    )
+
+
+def concatenate_shards(keys, dest):
+    """
+    Stream the S3 objects `keys` into `dest`, keeping the SAM header of
+    the first only. Returns the number of records written.
+    """
+    proc = stream_to_s3(dest)
+    records = 0
+    succeeded = False
+    try:
+        for i, key in enumerate(keys):
+            for line in sh.aws(
+                "s3",
+                "cp",
+                "s3://{}/{}".format(os.getenv("BUCKET_NAME"), key),
+                "-",
+                _iter=True,
+            ):
+                if line.startswith("@"):
+                    if i == 0:
+                        proc.stdin.write(line.encode())
+                    continue
+                proc.stdin.write(line.encode())
+                records += 1
+        succeeded = True
+    finally:
+        close_streams({dest: proc}, succeeded)
+    return records
+
+
+def merge_shards(sra_accession, count):
+    """
+    Concatenate the outputs of the `count` shards of an accession into
+    the usual per-reference sam files (and list of ambiguous reads),
+    write a summary to {PREFIX}-summaries/{accession}/{accession}.json
+    and remove the shards. Exits with an error if any shard is missing
+    or the shards disagree about their input.
+    """
+    shards = []
+    for index in range(count):
+        try:
+            shards.append(
+                json.loads(
+                    str(
+                        sh.aws(
+                            "s3",
+                            "cp",
+                            "s3://{}/{}".format(
+                                os.getenv("BUCKET_NAME"),
+                                shard_key(sra_accession, index, "summary.json"),
+                            ),
+                            "-",
+                        )
+                    )
+                )
+            )
+        except sh.ErrorReturnCode:
+            fprint("shard {} of {} has not been aligned".format(index + 1, count))
+            sys.exit(1)
+    if len({json.dumps([x["reads"], x["read_handling"]]) for x in shards}) > 1:
+        fprint("shards disagree about their input: {}".format(shards))
+        sys.exit(1)
+    summary = dict(
+        accession=sra_accession,
+        shards=count,
+        reads=shards[0]["reads"],
+        read_handling=shards[0]["read_handling"],
+        records={},
+    )
+    with Timer() as timer:
+        for virus in get_references():
+            fprint("merging {} shards for {} ...".format(count, virus))
+            summary["records"][virus] = concatenate_shards(
+                [
+                    shard_key(sra_accession, x, "{}.sam".format(virus))
+                    for x in range(count)
+                ],
+                output_key(sra_accession, virus),
+            )
+        if os.getenv("COMBINED_INDEX"):
+            summary["ambiguous"] = concatenate_shards(
+                [shard_key(sra_accession, x, "ambiguous.tsv") for x in range(count)],
+                get_ambiguous_key(sra_accession),
+            )
+    fprint("duration of merge: {}".format(timer.interval))
+    sh.aws(
+        "s3",
+        "cp",
+        "-",
+        "s3://{}/{}-summaries/{}/{}.json".format(
+            os.getenv("BUCKET_NAME"), os.getenv("PREFIX"), sra_accession, sra_accession
+        ),
+        _in=json.dumps(summary, indent=4),
+    )
+    sh.aws(
+        "s3",
+        "rm",
+        "s3://{}/{}-shards/{}/".format(
+            os.getenv("BUCKET_NAME"), os.getenv("PREFIX"), sra_accession
+        ),
+        "--recursive",
+    )
+
+
+def record_timing(stage, interval):
+    "add the duration of a stage to the timing record uploaded by upload_timings()"
+    TIMINGS[stage] = TIMINGS.get(stage, 0) + interval.total_seconds()
+
+
+def upload_timings(sra_accession, succeeded):
+    """
+    Upload this child's stage timings (in seconds) to
+    s3://BUCKET_NAME/pipeline-timings/<job id>/<array index>.json,
+    where sra_pipeline uses them to predict how long jobs will take.
+    """
+    if not os.getenv("AWS_BATCH_JOB_ID"):
+        return
+    sra_file = "sra/{}.sra".format(sra_accession)
+    record = dict(
+        accession=sra_accession,
+        job_id=os.getenv("AWS_BATCH_JOB_ID").split(":")[0],
+        array_index=int(os.getenv("AWS_BATCH_JOB_ARRAY_INDEX", "0")),
+        num_cores=int(os.getenv("NUM_CORES")),
+        references=get_references(),
+        combined_index=os.getenv("COMBINED_INDEX"),
+        shard=os.getenv("SHARD"),
+        allocations=SCHEDULER.decisions,
+        sra_bytes=os.path.getsize(sra_file) if os.path.exists(sra_file) else None,
+        succeeded=succeeded,
+        timings=TIMINGS,
+    )
+    try:
+        sh.aws(
+            "s3",
+            "cp",
+            "-",
+            "s3://{}/pipeline-timings/{}/{}.json".format(
+                os.getenv("BUCKET_NAME"), record["job_id"], record["array_index"]
+            ),
+            _in=json.dumps(record),
+        )
+    except sh.ErrorReturnCode:
+        fprint("could not upload timings")
+
+
+def remove_outputs(sra_accession):
+    "remove the (possibly partial) output of a failed alignment from S3"
+    shard = current_shard()
+    if shard:
+        targets = [
+            "{}-shards/{}/{}/".format(os.getenv("PREFIX"), sra_accession, shard[0])
+        ]
+    else:
+        # only this job's references: other jobs may have written results
+        # for other references under the same accession
+        targets = [
+            "{}/{}/{}/".format(os.getenv("PREFIX"), sra_accession, ref)
+            for ref in get_references()
+        ]
+    for target in targets:
+        sh.aws(
+            "s3",
+            "rm",
+            "s3://{}/{}".format(os.getenv("BUCKET_NAME"), target),
+            "--recursive",
         )
-        results.append(result)
-    return results[0], results[1]
 
 
 def cleanup(scratch):
@@ -362,8 +1806,9 @@ def add_to_path(directory):
     print("Added {} to PATH.".format(directory))
 
 
-def main():
+def main():  # pylint: disable=too-many-statements,too-many-branches
     "do the work"
+    start = datetime.datetime.now()
     ensure_correct_environment()
     add_to_path("/home/neo/miniconda3/bin")
     add_to_path("/bowtie2-2.3.4.1-linux-x86_64")
@@ -375,43 +1820,68 @@ def main():
     sh.aws("s3", "cp", "s3://fh-pi-jerome-k/pipeline-auth-files/prj_19838.ngc", ".")
     sh.vdb_config("--import", "prj_19838.ngc")
     scratch, sra_accession = setup_scratch()
+    sra_accession, _, shard = sra_accession.partition(SHARD_SEP)
+    if os.getenv("MERGE_SHARDS"):
+        try:
+            merge_shards(sra_accession, int(shard))
+        finally:
+            cleanup(scratch)
+        return
+    if shard and not os.getenv("PREPARE_SHARDS"):
+        os.environ["SHARD"] = shard
     with working_directory(Path("{}/ncbi/dbGaP-19838".format(HOME))):
         sh.mkdir("-p", PTMP)
         clean_directory(PTMP)
         fprint("sra accession is {}".format(sra_accession))
         fprint("scratch is {}".format(scratch))
-        if not get_fastq_files_from_s3(sra_accession):
+        if os.getenv("PREPARE_SHARDS"):
+            try:
+                prepare_shards(sra_accession)
+            finally:
+                cleanup(scratch)
+            return
+        prepared = current_shard() and fetch_prepared(sra_accession)
+        upload = None
+        if not prepared and not get_fastq_files_from_s3(sra_accession):
             download_from_sra(sra_accession)
             run_fastq_dump(sra_accession)
-            copy_fastqs_to_s3(sra_accession)
+            upload = start_fastq_upload(sra_accession)
 
+        align = run_bowtie_combined if os.getenv("COMBINED_INDEX") else run_bowtie
+        read_handling = (
+            shard_read_handling(sra_accession) if current_shard() else "equal"
+        )
+        succeeded = False
         try:
-            run_bowtie(sra_accession)
+            align(sra_accession, read_handling)
+            succeeded = True
         except sh.ErrorReturnCode_134 as exc:
-            sh.aws(
-                "s3",
-                "rm",
-                "s3://{}/{}/{}/".format(
-                    os.getenv("BUCKET_NAME"), os.getenv("PREFIX"), sra_accession
-                ),
-                "--recursive",
-            )
+            remove_outputs(sra_accession)
             errtxt = str(exc)
             if "fewer reads in file specified with -2" in errtxt:
                 fprint(
                     "Oops, -2 file has fewer reads than -1 file, trying again with -1 only"
                 )
-                run_bowtie(sra_accession, 1)
+                read_handling = 1
+                align(sra_accession, read_handling)
+                succeeded = True
             elif "fewer reads in file specified with -1" in errtxt:
                 fprint(
                     "Oops, -1 file has fewer reads than -2 file, trying again with -2 only"
                 )
-                run_bowtie(sra_accession, 2)
+                read_handling = 2
+                align(sra_accession, read_handling)
+                succeeded = True
         except:  # pylint: disable=bare-except
             fprint("Unexpected exception:")
             fprint(traceback.print_exception(*sys.exc_info()))
             sys.exit(1)
         finally:  # hopefully we still exit with an error code if there was an error
+            finish_fastq_upload(upload, sra_accession)
+            if succeeded and current_shard():
+                upload_shard_summary(sra_accession, read_handling)
+            record_timing("total", datetime.datetime.now() - start)
+            upload_timings(sra_accession, succeeded)
             cleanup(scratch)
 
 
@@ -0,0 +1,38 @@
+"""
+Shared AWS clients for the SRA pipeline tools.
+
+boto3 is slow to import and every client it creates sets up its own
+connection pool, so clients are created once per process (lazily, on
+first use) from a single session and shared by all callers, including
+worker threads. Throttling is handled by botocore's adaptive retry mode
+rather than by hand.
+"""
+
+import threading
+
+MAX_POOL_CONNECTIONS = 32
+MAX_ATTEMPTS = 10
+
+_LOCK = threading.Lock()
+_SESSION = None
+_CLIENTS = {}
+
+
+def client(service):
+    "return the shared client for an AWS service, creating it if needed"
+    global _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        if service not in _CLIENTS:
+            import boto3
+            from botocore.config import Config
+
+            if _SESSION is None:
+                _SESSION = boto3.session.Session()
+            _CLIENTS[service] = _SESSION.client(
+                service,
+                config=Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS,
+                    retries=dict(mode="adaptive", max_attempts=MAX_ATTEMPTS),
+                ),
+            )
+        return _CLIENTS[service]
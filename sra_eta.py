@@ -0,0 +1,216 @@
+"""
+Throughput model and ETA for SRA pipeline array jobs.
+
+run.py uploads a timing record for every child to
+s3://<bucket>/pipeline-timings/<job id>/<array index>.json. We fit
+wall time against .sra size (from the size CSVs) on those records, and
+combine the fit with the live state of a job's children to predict how
+much longer it will run and how many instance-hours that will take.
+"""
+
+import csv
+import datetime
+import json
+import os
+import statistics
+
+import sra_state
+
+SIZE_CSVS = ["srr-sizes.csv", "srr-sizes3.csv", "salivary_sizes.csv", "fastq-sras.csv"]
+TIMINGS_PREFIX = "pipeline-timings/"
+MODEL_FILE = os.path.join(os.path.dirname(sra_state.STATE_FILE), "model.json")
+
+# stages run once per child before aligning (see child_stages()); bowtie2
+# runs once per reference, or once in all ("bowtie2-combined") with a
+# combined index
+FASTQ_STAGES = ["download", "fastq-dump", "bgzf"]
+CACHED_STAGES = ["fastq-cache"]
+UNFINISHED_STATES = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
+STRAGGLER_FACTOR = 2.0
+
+
+def load_sizes(directory):
+    "return a dict of accession -> .sra size in bytes from the size CSVs"
+    sizes = {}
+    for name in SIZE_CSVS:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            continue
+        with open(path) as fileh:
+            for row in csv.DictReader(fileh):
+                sizes[row["accession_number"]] = int(row["size"])
+    return sizes
+
+
+def load_timing_records(s3, bucket):  # pylint: disable=invalid-name
+    "fetch all timing records uploaded by run.py"
+    records = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=TIMINGS_PREFIX):
+        for item in page.get("Contents", []):
+            obj = s3.get_object(Bucket=bucket, Key=item["Key"])
+            records.append(json.loads(obj["Body"].read().decode("utf-8")))
+    return records
+
+
+def fit_line(sizes, seconds):
+    """
+    least squares fit of seconds = slope * size + intercept,
+    returns [slope, intercept, residual standard deviation, n]
+    """
+    if len(sizes) < 2 or len(set(sizes)) < 2:
+        mean = statistics.mean(seconds) if seconds else 0.0
+        return [0.0, mean, 0.0, len(seconds)]
+    import numpy as np
+
+    slope, intercept = np.polyfit(sizes, seconds, 1)
+    residuals = np.array(seconds) - (slope * np.array(sizes) + intercept)
+    return [float(slope), float(intercept), float(np.std(residuals)), len(sizes)]
+
+
+def fit_model(records, sizes):
+    """
+    Fit wall time against .sra size for each stage. bowtie2 stages are
+    pooled into a per-reference fit ("bowtie2"); predictions add up the
+    stage fits (see predict()). "total", the whole child from start to
+    finish, is fitted for reference only. Stages are fitted on the
+    children that ran them, so e.g. "download" assumes no fastq cache.
+    Only successful children with a known size are used, and not those
+    that aligned a shard of an accession.
+    """
+    points = {}
+    for record in records:
+        if not record.get("succeeded") or record.get("shard"):
+            continue
+        size = sizes.get(record["accession"]) or record.get("sra_bytes")
+        if not size:
+            continue
+        timings = record["timings"]
+        per_ref = [v for k, v in timings.items() if k.startswith("bowtie2:")]
+        stages = {k: v for k, v in timings.items() if not k.startswith("bowtie2:")}
+        if per_ref:
+            stages["bowtie2"] = statistics.mean(per_ref)
+        for stage, seconds in stages.items():
+            points.setdefault(stage, ([], []))
+            points[stage][0].append(size)
+            points[stage][1].append(seconds)
+    return {stage: fit_line(*xy) for stage, xy in sorted(points.items())}
+
+
+def save_model(model, path=MODEL_FILE):
+    "save a fitted model"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fileh:
+        json.dump(model, fileh, indent=4, sort_keys=True)
+
+
+def load_model(path=MODEL_FILE):
+    "load a model saved with save_model(), or None"
+    if not os.path.exists(path):
+        return None
+    with open(path) as fileh:
+        return json.load(fileh)
+
+
+def stage_seconds(model, stage, size):
+    "predicted seconds for one stage, 0 if the model has no fit for it"
+    if stage not in model:
+        return 0.0
+    slope, intercept = model[stage][:2]
+    return max(slope * size + intercept, 0.0)
+
+
+def can_predict(model):
+    "whether the model has the fits predict() needs"
+    return bool(model) and ("bowtie2" in model or "bowtie2-combined" in model)
+
+
+def child_stages(env, cached):
+    """
+    the stages before aligning that a child of a job with environment
+    `env` runs: fetching the fastq cache, or making fastqs from the .sra
+    if the accession is not cached, then collapsing duplicates if asked
+    """
+    stages = list(CACHED_STAGES if cached else FASTQ_STAGES)
+    if env.get("COLLAPSE_DUPLICATES"):
+        stages.append("collapse")
+    return stages
+
+
+def predict(model, size, env, cached=False):
+    """
+    predicted wall time in seconds of a child of a job with environment
+    `env` for an accession of `size` bytes: the sum of the fits for the
+    stages it runs, with bowtie2 counted once per reference, or once if
+    a combined index is used
+    """
+    seconds = sum(stage_seconds(model, x, size) for x in child_stages(env, cached))
+    num_references = len(env["REFERENCES"].split(","))
+    if env.get("COMBINED_INDEX"):
+        if "bowtie2-combined" in model:
+            return seconds + stage_seconds(model, "bowtie2-combined", size)
+        return seconds + stage_seconds(model, "bowtie2", size)
+    if "bowtie2" not in model:
+        return seconds + stage_seconds(model, "bowtie2-combined", size)
+    return seconds + stage_seconds(model, "bowtie2", size) * num_references
+
+
+def list_children(batch, job_id):
+    "return summaries of all unfinished children of an array job"
+    children = []
+    paginator = batch.get_paginator("list_jobs")
+    for state in UNFINISHED_STATES:
+        for page in paginator.paginate(arrayJobId=job_id, jobStatus=state):
+            children.extend(page["jobSummaryList"])
+    return children
+
+
+def job_eta(model, job, children, accessions, now=None):
+    """
+    Predict the remaining work for an array job.
+    Args:
+        model: fitted model (see fit_model())
+        job: the job description from describe_jobs
+        children: unfinished child summaries (see list_children())
+        accessions: for each line of the job's manifest, in array index
+            order, a dict with the line, its size in bytes and whether
+            its fastqs are cached
+    Returns a dict with remaining wall time and child-hours, and a list of
+    (array index, manifest line, elapsed seconds, predicted seconds) stragglers.
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    env = {x["name"]: x["value"] for x in job["container"]["environment"]}
+    running = []
+    waiting = []
+    stragglers = []
+    for child in children:
+        index = child["arrayProperties"]["index"]
+        accession = accessions[index]
+        predicted = predict(model, accession["size"], env, accession["cached"])
+        if child["status"] == "RUNNING" and "startedAt" in child:
+            elapsed = now - child["startedAt"] / 1000.0
+            running.append(max(predicted - elapsed, 0.0))
+            if elapsed > STRAGGLER_FACTOR * predicted:
+                stragglers.append((index, accession["line"], elapsed, predicted))
+        else:
+            waiting.append(predicted)
+    return summarize(running, waiting, stragglers, int(env["NUM_CORES"]))
+
+
+def summarize(running, waiting, stragglers, cores):
+    """
+    job_eta()'s result from the remaining seconds of running and waiting
+    children, assuming as many children keep running at once as now
+    """
+    concurrency = max(len(running), 1)
+    child_seconds = sum(running) + sum(waiting)
+    wall = max(max(running, default=0.0), child_seconds / concurrency)
+    return dict(
+        running=len(running),
+        waiting=len(waiting),
+        remaining_wall_hours=wall / 3600,
+        remaining_child_hours=child_seconds / 3600,
+        remaining_vcpu_hours=child_seconds / 3600 * cores,
+        stragglers=stragglers,
+    )
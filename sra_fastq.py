@@ -0,0 +1,104 @@
+"""
+Migrate the fastq cache in S3 (pipeline-fastq/ and pipeline-fastq-salivary/)
+from plain gzip to BGZF with .gzi block indexes, the format run.py now
+writes, so that it can be decompressed with several threads.
+
+Requires gzip, bash and bgzip (from htslib) on the PATH.
+"""
+
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+
+CACHE_PREFIXES = ["pipeline-fastq/", "pipeline-fastq-salivary/"]
+
+
+def list_unmigrated(s3, bucket):  # pylint: disable=invalid-name
+    "return keys of cached fastqs that have no .gzi index yet"
+    keys = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for prefix in CACHE_PREFIXES:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.update(x["Key"] for x in page.get("Contents", []))
+    return sorted(
+        x for x in keys if x.endswith(".fastq.gz") and "{}.gzi".format(x) not in keys
+    )
+
+
+def list_cached(s3, bucket):  # pylint: disable=invalid-name
+    "return the accessions with both fastqs in the cache"
+    keys = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for prefix in CACHE_PREFIXES:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys.update(x["Key"] for x in page.get("Contents", []) if x["Size"] > 0)
+    return {
+        x.split("/")[1]
+        for x in keys
+        if x.endswith("_1.fastq.gz")
+        and "{}2.fastq.gz".format(x[: -len("1.fastq.gz")]) in keys
+    }
+
+
+def is_cached(s3, bucket, accession):  # pylint: disable=invalid-name
+    "whether both fastqs of an accession are in the cache"
+    for prefix in CACHE_PREFIXES:
+        keys = [
+            "{}{}/{}_{}.fastq.gz".format(prefix, accession, accession, x)
+            for x in (1, 2)
+        ]
+        resp = s3.list_objects_v2(
+            Bucket=bucket, Prefix="{}{}/".format(prefix, accession)
+        )
+        found = {x["Key"] for x in resp.get("Contents", []) if x["Size"] > 0}
+        if all(x in found for x in keys):
+            return True
+    return False
+
+
+def migrate(s3, bucket, key, threads):  # pylint: disable=invalid-name
+    """
+    Recompress one cached fastq as BGZF. The new data is streamed to a
+    temporary key and only copied over the original once the whole
+    pipeline has succeeded; the .gzi index is uploaded last, since its
+    presence is what marks the object as BGZF.
+    """
+    tmp_key = "{}.bgzf-tmp".format(key)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = os.path.join(tmpdir, "index.gzi")
+        proc = subprocess.Popen(
+            [
+                "bash",
+                "-c",
+                "set -o pipefail; gzip -dc | bgzip -@ {} -c -i -I {}".format(
+                    threads, shlex.quote(index)
+                ),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        errors = []
+
+        def feed():
+            "download the original into the pipeline"
+            try:
+                s3.download_fileobj(bucket, key, proc.stdin)
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+            finally:
+                proc.stdin.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        s3.upload_fileobj(proc.stdout, bucket, tmp_key)
+        feeder.join()
+        if proc.wait() or errors:
+            s3.delete_object(Bucket=bucket, Key=tmp_key)
+            raise RuntimeError(
+                "recompressing {} failed: {}".format(key, errors or proc.returncode)
+            )
+        s3.copy({"Bucket": bucket, "Key": tmp_key}, bucket, key)
+        s3.delete_object(Bucket=bucket, Key=tmp_key)
+        s3.upload_file(index, bucket, "{}.gzi".format(key))
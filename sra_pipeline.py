@@ -9,24 +9,41 @@ import datetime
 import io
 import json
 import os
+import statistics
 import sys
-from time import sleep
 
 from multiprocessing.pool import ThreadPool
 from collections import defaultdict
 from math import ceil
 from urllib.parse import urlparse
 
-import boto3
-from botocore.exceptions import ClientError
-import numpy as np
+import sra_aws
+import sra_eta
+import sra_fastq
+import sra_retry
+import sra_state
 
 # import pandas as pd
 
 PREFIX = "pipeline-results"
+BUCKET_NAME = "fh-pi-jerome-k"
+JOB_QUEUE = "mixed"
+DOWNLOAD_CONNECTIONS = 8
+SHARD_SEP = "#"  # as in run.py
+MAX_SHARDS = 16
 CSV_FILE = "salivary_sizes.csv"
 
-RETRY_EXCEPTIONS = ("ProvisionedThroughputExceededException", "ThrottlingException")
+# environment variables that submit_job() sets itself
+SUBMIT_ENV = (
+    "BATCH_FILE_TYPE",
+    "BATCH_FILE_URL",
+    "BUCKET_NAME",
+    "PREFIX",
+    "ACCESSION_LIST",
+    "NUM_CORES",
+    "REFERENCES",
+    "DISABLE_SLEEP",
+)
 
 
 def get_git_branch():
@@ -51,8 +68,8 @@ def inspect_logs(args):  # index, batch, logs, job_id, search_string):
     index = args["index"]
     search_string = args["search_string"]
     job_id = args["job_id"]
-    batch = boto3.client("batch")
-    logs = boto3.client("logs")
+    batch = sra_aws.client("batch")
+    logs = sra_aws.client("logs")
     child_id = "{}:{}".format(job_id, index)
     child_desc = batch.describe_jobs(jobs=[child_id])["jobs"][0]
     if not "container" in child_desc:
@@ -61,28 +78,20 @@ def inspect_logs(args):  # index, batch, logs, job_id, search_string):
         return False
     lsn = child_desc["container"]["logStreamName"]
     args = dict(logGroupName="/aws/batch/job", logStreamName=lsn)
-    retries = 0
     while True:
-        try:
-            resp = logs.get_log_events(**args)
-            if not resp["events"]:
-                return False
-            if "nextBackwardToken" in resp:
-                args["nextToken"] = resp["nextBackwardToken"]
-            for event in resp["events"]:
-                if search_string in event["message"]:
-                    return True
-        except ClientError as err:
-            if err.response["Error"]["Code"] not in RETRY_EXCEPTIONS:
-                raise
-            # print("retrying...")
-            sleep(2 ** retries)
-            retries += 1  # TODO max retries
+        resp = logs.get_log_events(**args)
+        if not resp["events"]:
+            return False
+        if "nextBackwardToken" in resp:
+            args["nextToken"] = resp["nextBackwardToken"]
+        for event in resp["events"]:
+            if search_string in event["message"]:
+                return True
 
 
 def search_logs(job_id, search_string):
     "search logs for a given string, return child indices where found"
-    batch = boto3.client("batch")
+    batch = sra_aws.client("batch")
     resp = batch.describe_jobs(jobs=[job_id])
     if not "jobs" in resp:
         raise ValueError("no such job")
@@ -121,6 +130,11 @@ def get_failsons(batch, job_id):
     return set(failsons)
 
 
+def manifest_accession(line):
+    "the accession number in a manifest line (which may name a shard, see submit())"
+    return line.partition(SHARD_SEP)[0]
+
+
 def get_env_var(job, env_var):
     "get the value of a specified environment variable from a job description"
     hsh = {}
@@ -129,63 +143,52 @@ def get_env_var(job, env_var):
     return hsh[env_var]
 
 
+def get_memory(job):
+    """
+    get the memory (in MiB) of a job from its description, whether it was
+    set with resourceRequirements or the older memory parameter
+    """
+    for item in job["container"].get("resourceRequirements", []):
+        if item["type"] == "MEMORY":
+            return int(item["value"])
+    return job["container"]["memory"]
+
+
 def show_completed(job_id):
     "show completed accession numbers"
-    s3 = boto3.client("s3")  # pylint: disable=invalid-name
-    batch = boto3.client("batch")
+    s3 = sra_aws.client("s3")  # pylint: disable=invalid-name
+    batch = sra_aws.client("batch")
     resp = batch.describe_jobs(jobs=[job_id])["jobs"]
     if not resp:
         print("No information on this job.")
         sys.exit(1)
     job = resp[0]
-    num_viruses = int(job["jobName"].split("-")[-1])
-
-    completed_map = defaultdict(list)
-    args = dict(
-        Bucket=get_env_var(job, "BUCKET_NAME"),
-        Prefix=get_env_var(job, "PREFIX"),
-        MaxKeys=999,
-    )
-    while True:
-        response = s3.list_objects_v2(**args)
-        if not "Contents" in response:
-            return []
-        for item in response["Contents"]:
-            segs = item["Key"].split("/")
-            accession = segs[1]
-            virus = segs[2]
-            completed_map[accession].append(virus)
-        try:
-            args["ContinuationToken"] = response["NextContinuationToken"]
-        except KeyError:
-            break
-    completed = [
-        x for x in completed_map.keys() if len(completed_map[x]) == num_viruses
-    ]
+    job_refs = set(x.strip() for x in get_env_var(job, "REFERENCES").split(","))
+
+    completed_map = defaultdict(set)
+    for accession, virus in sra_state.list_results(
+        s3, get_env_var(job, "BUCKET_NAME"), get_env_var(job, "PREFIX")
+    ):
+        completed_map[accession].add(virus)
+    completed = [x for x in completed_map.keys() if job_refs <= completed_map[x]]
     return completed
 
 
 def show_in_progress(job_id):  # pylint: disable=too-many-locals
     "show accession numbers that are in progress"
-    s3 = boto3.client("s3")  # pylint: disable=invalid-name
-    batch = boto3.client("batch")
+    s3 = sra_aws.client("s3")  # pylint: disable=invalid-name
+    batch = sra_aws.client("batch")
     in_progress_states = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
     state_jobs = []
     for state in in_progress_states:
-        results = batch.list_jobs(jobQueue="mixed", jobStatus=state)
+        results = batch.list_jobs(jobQueue=JOB_QUEUE, jobStatus=state)
         state_jobs.extend(results["jobSummaryList"])
     job_ids = [x["jobId"] for x in state_jobs]
     if not job_ids:
         return []
-    chunks = []
     jobs = []
-    if len(job_ids) <= 100:
-        chunks.append(job_ids)
-    else:
-        num_chunks = int(ceil(len(job_ids) / 100.0))
-        chunks = np.array_split(job_ids, num_chunks)
-    for chunk in chunks:
-        response = batch.describe_jobs(jobs=chunk)
+    for start in range(0, len(job_ids), 100):
+        response = batch.describe_jobs(jobs=job_ids[start : start + 100])
         jobs.extend(response["jobs"])
     accession_lists_map = {}
     for job in jobs:
@@ -203,7 +206,7 @@ def show_in_progress(job_id):  # pylint: disable=too-many-locals
         flh = io.BytesIO()
         s3.download_fileobj(bucket, key, flh)
         tmp = flh.getvalue().decode("utf-8").strip().split("\n")
-        tmp = [x for i, x in enumerate(tmp) if not i in failsons]
+        tmp = [manifest_accession(x) for i, x in enumerate(tmp) if not i in failsons]
         accession_nums.extend(tmp)
 
     completed = set(show_completed(job_id))
@@ -211,22 +214,160 @@ def show_in_progress(job_id):  # pylint: disable=too-many-locals
     return list(ret)
 
 
-def show_remaining(job_id, completed):
-    "show items still remaining in this job"
-    batch = boto3.client("batch")
-    job = batch.describe_jobs(jobs=[job_id])["jobs"][0]
-
+def get_accession_list(job):
+    "get the manifest lines of a job, in array index order"
     accession_list = get_env_var(job, "ACCESSION_LIST")
     parsed_url = urlparse(accession_list)
     bucket = parsed_url.netloc
     path = parsed_url.path.lstrip("/")
-    s3 = boto3.client("s3")  # pylint: disable=invalid-name
+    s3 = sra_aws.client("s3")  # pylint: disable=invalid-name
     obj = s3.get_object(Bucket=bucket, Key=path)
     accstr = obj["Body"].read().decode("utf-8")
-    all_sras = accstr.split("\n")
+    return accstr.split("\n")
+
+
+def show_remaining(job_id, completed):
+    "show items still remaining in this job"
+    batch = sra_aws.client("batch")
+    job = batch.describe_jobs(jobs=[job_id])["jobs"][0]
+    all_sras = [manifest_accession(x) for x in get_accession_list(job)]
     return set(all_sras) - set(completed)
 
 
+def resubmit_failed(job_id, dry_run=False):  # pylint: disable=too-many-locals
+    """
+    Classify the failed children of a job (a job that is not an array
+    job counts as one child, at index 0) and resubmit the retryable ones
+    (see sra_retry.RETRYABLE) as a single new array job, with more
+    memory if any of them ran out of it. Accessions that have
+    already been resubmitted sra_retry.MAX_ATTEMPTS times, or that the
+    state store shows as completed or in progress, are left alone.
+    Failed shards are resubmitted along with a new job to merge them.
+    Returns a list of (index, accession, failure class, action) and the
+    submit_job() result (None if nothing was submitted).
+    """
+    batch = sra_aws.client("batch")
+    resp = batch.describe_jobs(jobs=[job_id])["jobs"]
+    if not resp:
+        raise ValueError("no such job")
+    job = resp[0]
+    prefix = get_env_var(job, "PREFIX")
+    accession_nums = get_accession_list(job)
+    if "arrayProperties" in job:
+        failed = sorted(get_failsons(batch, job_id))
+    else:
+        failed = [0] if job["status"] == "FAILED" else []
+    failures = sra_retry.classify_failures(batch, sra_aws.client("logs"), job, failed)
+    references = get_env_var(job, "REFERENCES")
+    conn = sra_state.open_state()
+    sra_state.sync_state(
+        conn, sra_aws.client("s3"), batch, BUCKET_NAME, prefix, queue=JOB_QUEUE
+    )
+    missing = sra_state.missing_references(
+        conn,
+        prefix,
+        [manifest_accession(accession_nums[x]) for x in failures],
+        [x.strip() for x in references.split(",")],
+    )
+    merging = any(x["name"] == "MERGE_SHARDS" for x in job["container"]["environment"])
+    report = []
+    retry = []
+    for index, failure in sorted(failures.items()):
+        accession = manifest_accession(accession_nums[index])
+        attempts = sra_state.retry_attempts(conn, prefix, accession)
+        if not missing[accession]:
+            action = "completed or in progress"
+        elif failure == sra_retry.DEPENDENCY and merging:
+            # resubmitting the failed shards submits a new merge job
+            action = "resubmit the shards instead"
+        elif failure not in sra_retry.RETRYABLE:
+            action = "not retryable"
+        elif attempts >= sra_retry.MAX_ATTEMPTS:
+            action = "gave up after {} attempts".format(attempts)
+        else:
+            action = "resubmit"
+            retry.append(
+                dict(
+                    accession=accession,
+                    source_job=job_id,
+                    source_index=index,
+                    failure=failure,
+                    attempt=attempts + 1,
+                )
+            )
+        report.append((index, accession, failure, action))
+    if dry_run or not retry:
+        return report, None
+    memory = None
+    if any(x["failure"] == sra_retry.OOM for x in retry):
+        memory = int(get_memory(job) * sra_retry.OOM_MEMORY_FACTOR)
+    job_env = {
+        x["name"]: x["value"]
+        for x in job["container"]["environment"]
+        if x["name"] not in SUBMIT_ENV
+    }
+    lines = [accession_nums[x["source_index"]] for x in retry]
+    res = submit_job(lines, references, prefix, job_env, memory, retry)
+    sra_state.record_submission(
+        conn,
+        res["jobId"],
+        prefix,
+        [manifest_accession(x) for x in lines],
+        references.split(","),
+    )
+    submit_merge_job(conn, lines, references, prefix, job_env, res["jobId"])
+    for accession in {x["accession"] for x in retry}:
+        sra_state.add_retry_attempt(conn, prefix, accession)
+    return report, res
+
+
+def migrate_fastq_cache():
+    "recompress every cached fastq not yet in BGZF format"
+    s3 = sra_aws.client("s3")  # pylint: disable=invalid-name
+    keys = sra_fastq.list_unmigrated(s3, BUCKET_NAME)
+    print("{} cached fastqs to migrate".format(len(keys)))
+    for i, key in enumerate(keys):
+        print("{}/{} {}".format(i + 1, len(keys), key))
+        try:
+            sra_fastq.migrate(s3, BUCKET_NAME, key, os.cpu_count())
+        except RuntimeError as exc:
+            print(exc)
+
+
+def fit_throughput_model():
+    "fit the throughput model on all timing records uploaded by run.py and save it"
+    records = sra_eta.load_timing_records(sra_aws.client("s3"), BUCKET_NAME)
+    model = sra_eta.fit_model(records, sra_eta.load_sizes(get_script_directory()))
+    sra_eta.save_model(model)
+    return model
+
+
+def show_eta(job_id):
+    "predict remaining wall time and instance-hours of an array job"
+    model = sra_eta.load_model() or fit_throughput_model()
+    if not sra_eta.can_predict(model):
+        print("No timing records to base a prediction on yet.")
+        sys.exit(1)
+    batch = sra_aws.client("batch")
+    resp = batch.describe_jobs(jobs=[job_id])["jobs"]
+    if not resp:
+        print("No information on this job.")
+        sys.exit(1)
+    job = resp[0]
+    children = sra_eta.list_children(batch, job_id)
+    sizes = sra_eta.load_sizes(get_script_directory())
+    default_size = statistics.median(sizes.values()) if sizes else 0
+    cached = sra_fastq.list_cached(sra_aws.client("s3"), BUCKET_NAME)
+    accessions = []
+    for line in get_accession_list(job):
+        accession, _, shard = line.partition(SHARD_SEP)
+        size = sizes.get(accession, default_size)
+        if "/" in shard:
+            size /= int(shard.split("/")[1])
+        accessions.append(dict(line=line, size=size, cached=accession in cached))
+    return sra_eta.job_eta(model, job, children, accessions)
+
+
 # def select_from_csv(num_rows, method):
 #     """
 #     Selects accession numbers from the csv file.
@@ -279,33 +420,44 @@ def get_latest_jobdef_revision(batch_client, jobdef_name):  # FIXME handle pagin
     return (revision, cpus)
 
 
-def submit(references, filename=None, prefix=None):  # pylint: disable=too-many-locals
+def submit_job(
+    accession_nums,
+    references,
+    prefix,
+    job_env=None,
+    memory=None,
+    index_info=None,
+    depends_on=None,
+):  # pylint: disable=too-many-locals,too-many-arguments
     """
-    Utility function to submit jobs.
+    Submit a single (array) job.
     Args:
-        num_rows: Number of accession numbers to process, passed to select_from_csv()
-        method: 'random', 'small' (passed to select_from_csv()), or 'filename'
-        filename: list of accession numbers
-        prefix: optional s3 prefix at which to write output
+        accession_nums: list of manifest lines (accession numbers, or
+                        shards, see submit()), one per array child
+        references: comma-separated list of references
+        prefix: s3 prefix at which to write output
+        job_env: optional dict of extra environment variables for run.py
+        memory: optional memory (MiB) to override the job definition's
+        index_info: optional list with one JSON-serializable item per
+                    accession, uploaded next to the manifest as <manifest>.json
+        depends_on: optional id of a job that must finish first
     """
-    s3 = boto3.client("s3")  # pylint: disable=invalid-name
-    batch = boto3.client("batch")
+    s3 = sra_aws.client("s3")  # pylint: disable=invalid-name
+    batch = sra_aws.client("batch")
     now = datetime.datetime.now()
     nowstr = now.strftime("%Y%m%d%H%M%S")
-    if filename:
-        with open(filename, "r") as fileh:
-            accession_nums = fileh.readlines()
-            accession_nums = [x.strip() for x in accession_nums]
-    # else:
-    #     accession_nums = select_from_csv(num_rows, method)
     bytesarr = bytearray("\n".join(accession_nums), "utf-8")
     bytesio = io.BytesIO(bytesarr)
     job_size = len(accession_nums)
-    key = "{}-{}.txt".format(nowstr, job_size)
-    url = "s3://fh-pi-jerome-k/sra-submission-manifests/{}".format(key)
-    s3.upload_fileobj(
-        bytesio, "fh-pi-jerome-k", "sra-submission-manifests/{}".format(key)
-    )
+    key = "{}-{}.txt".format(now.strftime("%Y%m%d%H%M%S%f"), job_size)
+    url = "s3://{}/sra-submission-manifests/{}".format(BUCKET_NAME, key)
+    s3.upload_fileobj(bytesio, BUCKET_NAME, "sra-submission-manifests/{}".format(key))
+    if index_info:
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key="sra-submission-manifests/{}.json".format(key),
+            Body=json.dumps(index_info, indent=4).encode("utf-8"),
+        )
     reflen = len(references.split(","))
     job_name = "sra-pipeline-{}-{}-{}-refs-{}".format(
         os.getenv("USER"), nowstr, job_size, reflen
@@ -315,14 +467,12 @@ def submit(references, filename=None, prefix=None):  # pylint: disable=too-many-
     )  # use "hello" for testing, "sra-pipeline" for production
     revision, cpus = get_latest_jobdef_revision(batch, job_def_name)
     jobdef = "{}:{}".format(job_def_name, revision)
-    if not prefix:
-        prefix = PREFIX
     raw_env = dict(
         BATCH_FILE_TYPE="script",
         BATCH_FILE_URL="https://raw.githubusercontent.com/FredHutch/sra-pipeline/{}/run.py".format(
             get_git_branch()
         ),
-        BUCKET_NAME="fh-pi-jerome-k",
+        BUCKET_NAME=BUCKET_NAME,
         PREFIX=prefix,
         ACCESSION_LIST=url,
         NUM_CORES=cpus,
@@ -330,21 +480,175 @@ def submit(references, filename=None, prefix=None):  # pylint: disable=too-many-
     )
     if os.getenv("DISABLE_SLEEP"):
         raw_env["DISABLE_SLEEP"] = "True"
+    if job_env:
+        raw_env.update(job_env)
     env = to_aws_env(raw_env)
     args = dict(
         jobName=job_name,
-        jobQueue="mixed",
+        jobQueue=JOB_QUEUE,
         jobDefinition=jobdef,
         containerOverrides=dict(environment=env),
     )
+    if memory:
+        args["containerOverrides"]["resourceRequirements"] = [
+            dict(type="MEMORY", value=str(memory))
+        ]
     if job_size > 1:
         args["arrayProperties"] = dict(size=job_size)
+    if depends_on:
+        args["dependsOn"] = [dict(jobId=depends_on)]
     res = batch.submit_job(**args)
 
     del res["ResponseMetadata"]
     return res
 
 
+def num_shards(s3, accession, size, shard_gb):  # pylint: disable=invalid-name
+    """
+    number of shards to split an accession of `size` bytes into; only
+    accessions whose fastqs are cached are split, since otherwise every
+    shard would download and convert the whole .sra
+    """
+    if not shard_gb or not size or size <= shard_gb * 1e9:
+        return 1
+    if not sra_fastq.is_cached(s3, BUCKET_NAME, accession):
+        return 1
+    return min(int(ceil(size / (shard_gb * 1e9))), MAX_SHARDS)
+
+
+def submit_merge_job(
+    conn, lines, references, prefix, job_env, depends_on
+):  # pylint: disable=too-many-arguments
+    """
+    Submit a job, to run once job `depends_on` has finished, merging the
+    shards named in the manifest `lines` (one child per accession).
+    Returns the submit_job() result, or None if there are no shards.
+    """
+    shards = {}
+    for line in lines:
+        accession, _, shard = line.partition(SHARD_SEP)
+        if "/" in shard:
+            shards[accession] = shard.split("/")[1]
+    if not shards:
+        return None
+    res = submit_job(
+        ["{}{}{}".format(x, SHARD_SEP, y) for x, y in shards.items()],
+        references,
+        prefix,
+        dict(job_env or {}, MERGE_SHARDS="True"),
+        depends_on=depends_on,
+    )
+    sra_state.record_submission(
+        conn, res["jobId"], prefix, list(shards), references.split(",")
+    )
+    return res
+
+
+def submit(
+    references,
+    filename=None,
+    prefix=None,
+    dedupe=True,
+    job_env=None,
+    shard_gb=None,
+):  # pylint: disable=too-many-arguments,too-many-locals
+    """
+    Utility function to submit jobs.
+    Args:
+        references: comma-separated list of references
+        filename: list of accession numbers
+        prefix: optional s3 prefix at which to write output
+        dedupe: if True, consult the local state store and skip
+                (accession, reference) pairs that are already completed
+                or in progress. Accessions are grouped by the references
+                they still need and one job is submitted per group.
+        job_env: passed to submit_job()
+        shard_gb: if given, accessions with cached fastqs whose .sra is
+                  larger than this many GB (per the size CSVs) are split
+                  into shards of about that size (at most MAX_SHARDS),
+                  one child each, with manifest lines like SRR123#2/8.
+                  Each sharded accession is submitted as its own job
+                  (see submit_sharded()), so a failure elsewhere can't
+                  fail the merge.
+    Returns a list of submit_job() results.
+    """
+    if filename:
+        with open(filename, "r") as fileh:
+            accession_nums = fileh.readlines()
+            accession_nums = [x.strip() for x in accession_nums]
+            accession_nums = [x for x in accession_nums if x]
+    # else:
+    #     accession_nums = select_from_csv(num_rows, method)
+    if not prefix:
+        prefix = PREFIX
+    reflist = [x.strip() for x in references.split(",")]
+    conn = sra_state.open_state()
+    if dedupe:
+        sra_state.sync_state(
+            conn,
+            sra_aws.client("s3"),
+            sra_aws.client("batch"),
+            BUCKET_NAME,
+            prefix,
+            queue=JOB_QUEUE,
+        )
+        missing = sra_state.missing_references(conn, prefix, accession_nums, reflist)
+    else:
+        missing = {x: reflist for x in accession_nums}
+    groups = defaultdict(list)
+    for accession, refs in missing.items():
+        if refs:
+            groups[",".join(refs)].append(accession)
+    sizes = sra_eta.load_sizes(get_script_directory()) if shard_gb else {}
+    results = []
+    for refs, accessions in groups.items():
+        jobs = [[]]  # manifests: unsharded accessions, then one per sharded one
+        for accession in accessions:
+            count = num_shards(
+                sra_aws.client("s3"), accession, sizes.get(accession), shard_gb
+            )
+            if count == 1:
+                jobs[0].append(accession)
+            else:
+                jobs.append(
+                    [
+                        "{}{}{}/{}".format(accession, SHARD_SEP, x, count)
+                        for x in range(count)
+                    ]
+                )
+        if jobs[0]:
+            res = submit_job(jobs[0], refs, prefix, job_env)
+            sra_state.record_submission(
+                conn, res["jobId"], prefix, jobs[0], refs.split(",")
+            )
+            results.append(res)
+        for lines in jobs[1:]:
+            results.extend(submit_sharded(conn, lines, refs, prefix, job_env))
+    return results
+
+
+def submit_sharded(conn, lines, references, prefix, job_env):
+    """
+    Submit the shards of one accession (manifest `lines`) as an array job,
+    after a job that prepares their input once (run.py's PREPARE_SHARDS,
+    manifest line SRR123#8) and before one that merges them (see
+    submit_merge_job()). Returns the three submit_job() results.
+    """
+    accession, _, shard = lines[0].partition(SHARD_SEP)
+    prepare = submit_job(
+        ["{}{}{}".format(accession, SHARD_SEP, shard.split("/")[1])],
+        references,
+        prefix,
+        dict(job_env or {}, PREPARE_SHARDS="True"),
+    )
+    res = submit_job(lines, references, prefix, job_env, depends_on=prepare["jobId"])
+    sra_state.record_submission(
+        conn, res["jobId"], prefix, [accession] * len(lines), references.split(",")
+    )
+    merge = submit_merge_job(conn, lines, references, prefix, job_env, res["jobId"])
+    return [prepare, res, merge]
+
+
 # def submit_small(num_jobs, references):
 #     "submit <num_jobs> jobs of ascending size"
 #     return submit(num_jobs, "small", references)
@@ -355,13 +659,78 @@ def submit(references, filename=None, prefix=None):  # pylint: disable=too-many-
 #     return submit(num_jobs, "random", references)
 
 
-def submit_file(filename, references, prefix=None):
+def sync_state_counts(prefix):
+    "fully resync the state store for prefix, return (status, count) pairs"
+    conn = sra_state.open_state()
+    sra_state.sync_state(
+        conn,
+        sra_aws.client("s3"),
+        sra_aws.client("batch"),
+        BUCKET_NAME,
+        prefix,
+        True,
+        JOB_QUEUE,
+    )
+    return sra_state.status_counts(conn, prefix)
+
+
+def submit_file(
+    filename,
+    references,
+    prefix=None,
+    dedupe=True,
+    job_env=None,
+    shard_gb=None,
+):  # pylint: disable=too-many-arguments
     "submit accession numbers from filename"
-    return submit(references, filename, prefix)
+    return submit(references, filename, prefix, dedupe, job_env, shard_gb)
 
 
-def main():
-    "do the work"
+def combined_index_references(index):
+    """
+    references in a combined index, as listed by combine_references.py,
+    or None if the index has no list
+    """
+    path = os.path.join(get_script_directory(), "bt2", "{}.references".format(index))
+    if not os.path.exists(path):
+        return None
+    with open(path) as fileh:
+        return [x.strip() for x in fileh if x.strip()]
+
+
+def check_combined_index(index, references):
+    "exit unless combined index `index` has sequences for all of `references`"
+    indexed = combined_index_references(index)
+    if indexed is None:
+        print(
+            "bt2/{}.references not found, rebuild the index with "
+            "combine_references.py.".format(index)
+        )
+        sys.exit(1)
+    missing = [x.strip() for x in references.split(",") if x.strip() not in indexed]
+    if missing:
+        print(
+            "Combined index {} has no sequences for {}.".format(
+                index, ", ".join(missing)
+            )
+        )
+        sys.exit(1)
+
+
+def job_env_from_args(args):
+    "extra run.py environment variables selected on the command line"
+    job_env = {}
+    if args.download_connections:
+        job_env["SRA_DOWNLOAD_CONNECTIONS"] = str(args.download_connections)
+    if args.combined_index:
+        job_env["COMBINED_INDEX"] = args.combined_index
+    if args.collapse_duplicates:
+        job_env["COLLAPSE_DUPLICATES"] = "True"
+    return job_env
+
+
+def make_parser():
+    "the command line parser"
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
@@ -433,8 +802,108 @@ def main():
         type=str,
         metavar="REFERENCES",
     )
+    parser.add_argument(
+        "--no-dedupe",
+        help="submit every accession/reference, even if completed or in progress",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--download-connections",
+        help="concurrent range requests per SRA download (0 to use prefetch)",
+        default=DOWNLOAD_CONNECTIONS,
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "-x",
+        "--combined-index",
+        help="align once against this combined index (see combine_references.py)"
+        " instead of once per reference",
+        type=str,
+        metavar="INDEX",
+    )
+    parser.add_argument(
+        "-d",
+        "--collapse-duplicates",
+        help="align exact duplicate reads only once (output is unchanged)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shard-gb",
+        help="split accessions with cached fastqs whose .sra is larger than GB"
+        " into shards of about GB each, aligned by separate children and merged",
+        type=float,
+        metavar="GB",
+    )
+    parser.add_argument(
+        "-e",
+        "--eta",
+        help="predict remaining wall time and instance-hours for an array job",
+        type=str,
+        metavar="JOB_ID",
+    )
+    parser.add_argument(
+        "--fit-model",
+        help="refit the throughput model used by --eta from run.py timing records",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resubmit-failed",
+        help="classify failed children of an array job and resubmit the retryable ones",
+        type=str,
+        metavar="JOB_ID",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        help="with --resubmit-failed, only show the classification",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--migrate-fastq-cache",
+        help="recompress cached fastqs in S3 as BGZF (needs bgzip)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sync",
+        help="fully resync the local state store for PREFIX and show counts",
+        action="store_true",
+    )
+
+    return parser
 
-    args = parser.parse_args()
+
+def print_model(model):
+    "show the fits made by fit_throughput_model()"
+    print("stage\tseconds/GB\tintercept\tstd\tn")
+    for stage, (slope, intercept, std, num) in model.items():
+        print(
+            "{}\t{:.1f}\t{:.0f}\t{:.0f}\t{}".format(
+                stage, slope * 1e9, intercept, std, num
+            )
+        )
+
+
+def print_eta(eta):
+    "show a prediction made by show_eta()"
+    print(
+        "{running} running, {waiting} waiting\n"
+        "remaining wall time: {remaining_wall_hours:.1f} hours "
+        "(assuming current concurrency)\n"
+        "remaining child-hours: {remaining_child_hours:.1f}\n"
+        "remaining vCPU-hours: {remaining_vcpu_hours:.1f}".format(**eta)
+    )
+    for index, accession, elapsed, predicted in eta["stragglers"]:
+        print(
+            "straggler: index {} ({}) running {:.1f}h, predicted {:.1f}h".format(
+                index, accession, elapsed / 3600, predicted / 3600
+            )
+        )
+
+
+def main():  # pylint: disable=too-many-branches
+    "do the work"
+    args = make_parser().parse_args()
 
     if args.submit_file:
         if not args.references:
@@ -442,6 +911,8 @@ def main():
                 "You must supply a comma-separated list of references with the -y flag."
             )
             sys.exit(1)
+        if args.combined_index:
+            check_combined_index(args.combined_index, args.references)
 
     if len(sys.argv) == 1:
         print("invoke with --help to see usage information.")
@@ -467,8 +938,32 @@ def main():
     #     result = submit_random(args.submit_random, args.references)
     #     print(json.dumps(result, sort_keys=True, indent=4))
     elif args.submit_file:
-        result = submit_file(args.submit_file, args.references, args.prefix)
+        result = submit_file(
+            args.submit_file,
+            args.references,
+            args.prefix,
+            not args.no_dedupe,
+            job_env_from_args(args),
+            args.shard_gb,
+        )
+        if not result:
+            print("Nothing to submit, all accessions completed or in progress.")
         print(json.dumps(result, sort_keys=True, indent=4))
+    elif args.fit_model:
+        print_model(fit_throughput_model())
+    elif args.eta:
+        print_eta(show_eta(args.eta))
+    elif args.resubmit_failed:
+        report, result = resubmit_failed(args.resubmit_failed, args.dry_run)
+        for index, accession, failure, action in report:
+            print("{}\t{}\t{}\t{}".format(index, accession, failure, action))
+        if result:
+            print(json.dumps(result, sort_keys=True, indent=4))
+    elif args.migrate_fastq_cache:
+        migrate_fastq_cache()
+    elif args.sync:
+        for status, count in sync_state_counts(args.prefix):
+            print("{}\t{}".format(status, count))
     elif args.job_id:
         result = search_logs(args.job_id, args.query)
         for item in result:
@@ -0,0 +1,84 @@
+"""
+Classify failed children of SRA pipeline array jobs, so that only
+failures worth retrying get resubmitted.
+"""
+
+PREFETCH = "prefetch"
+OOM = "oom"
+SPOT = "spot"
+MATE_MISMATCH = "mate_mismatch"
+DEPENDENCY = "dependency"  # a job this one depended on failed
+UNKNOWN = "unknown"
+
+RETRYABLE = (PREFETCH, OOM, SPOT, DEPENDENCY)
+MAX_ATTEMPTS = 3
+OOM_MEMORY_FACTOR = 2
+
+# substrings of run.py (or tool) output, checked in order
+LOG_SIGNATURES = [
+    ("prefetch exited with nonzero result-code", PREFETCH),
+    ("ranged download failed", PREFETCH),
+    ("fewer reads in file specified with", MATE_MISMATCH),
+    ("std::bad_alloc", OOM),
+    ("MemoryError", OOM),
+]
+
+
+def classify(child, messages):
+    """
+    Classify a failed child from its job description and the messages
+    at the end of its log. Returns one of the failure classes above.
+    """
+    status_reason = child.get("statusReason", "")
+    container = child.get("container", {})
+    if status_reason.startswith("Host EC2") and "terminated" in status_reason:
+        return SPOT
+    if status_reason.startswith("Dependent Job failed"):
+        return DEPENDENCY
+    if "OutOfMemoryError" in container.get("reason", ""):
+        return OOM
+    for signature, failure in LOG_SIGNATURES:
+        if any(signature in x for x in messages):
+            return failure
+    if container.get("exitCode") == 137:  # SIGKILL, most likely the OOM killer
+        return OOM
+    return UNKNOWN
+
+
+def describe_children(batch, job_id, indices):
+    "return child job descriptions for the given array indices"
+    child_ids = ["{}:{}".format(job_id, x) for x in indices]
+    children = []
+    for start in range(0, len(child_ids), 100):
+        children.extend(
+            batch.describe_jobs(jobs=child_ids[start : start + 100])["jobs"]
+        )
+    return children
+
+
+def tail_log(logs, child):
+    "return the messages at the end of a child's log (empty if it has none)"
+    if "logStreamName" not in child.get("container", {}):
+        return []
+    resp = logs.get_log_events(
+        logGroupName="/aws/batch/job",
+        logStreamName=child["container"]["logStreamName"],
+        startFromHead=False,
+    )
+    return [x["message"] for x in resp["events"]]
+
+
+def classify_failures(batch, logs, job, indices):
+    """
+    Classify the failed children at `indices` of the job described by
+    `job`. A job that is not an array job (e.g. a resubmission of a single
+    child) is its own child, at index 0. Returns a dict of array index ->
+    failure class.
+    """
+    if "arrayProperties" not in job:
+        return {0: classify(job, tail_log(logs, job))} if 0 in indices else {}
+    failures = {}
+    for child in describe_children(batch, job["jobId"], indices):
+        index = child["arrayProperties"]["index"]
+        failures[index] = classify(child, tail_log(logs, child))
+    return failures
@@ -0,0 +1,317 @@
+"""
+Local state store for the SRA pipeline.
+
+Keeps a SQLite database of accession -> reference -> status so that
+`sra_pipeline` can tell, without listing all of S3 or walking every
+Batch job, which (accession, reference) pairs are already completed
+or in flight.
+"""
+
+import datetime
+import os
+import sqlite3
+from urllib.parse import urlparse
+
+STATE_FILE = os.path.join(os.path.expanduser("~"), ".sra_pipeline", "state.db")
+
+COMPLETED = "completed"
+IN_PROGRESS = "in_progress"
+FAILED = "failed"
+
+# EXPIRED: no longer returned by describe_jobs (Batch forgets finished jobs)
+TERMINAL_JOB_STATES = ("SUCCEEDED", "FAILED", "EXPIRED")
+ACTIVE_JOB_STATES = ("SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING")
+SHARD_SEP = "#"  # as in run.py
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    prefix TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    status TEXT NOT NULL,
+    job_id TEXT,
+    array_index INTEGER,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (prefix, accession, reference)
+);
+CREATE INDEX IF NOT EXISTS pairs_job ON pairs (job_id, array_index);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    status TEXT NOT NULL,
+    submitted TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS synced_prefixes (
+    prefix TEXT PRIMARY KEY,
+    synced TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS retries (
+    prefix TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (prefix, accession)
+);
+"""
+
+
+def now():
+    "current time as a string"
+    return datetime.datetime.now().isoformat()
+
+
+def open_state(path=None):
+    "open (creating if necessary) the state database"
+    if not path:
+        path = os.getenv("SRA_PIPELINE_STATE", STATE_FILE)
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def set_status(
+    conn, prefix, accession, reference, status, job_id=None, index=None
+):  # pylint: disable=too-many-arguments
+    "record the status of an (accession, reference) pair"
+    conn.execute(
+        "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (prefix, accession, reference, status, job_id, index, now()),
+    )
+
+
+def record_submission(conn, job_id, prefix, accession_nums, references):
+    """
+    Record a newly submitted job. `accession_nums` is the manifest
+    in array index order and `references` a list of reference names.
+    """
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+            (job_id, prefix, "SUBMITTED", now()),
+        )
+        for index, accession in enumerate(accession_nums):
+            for reference in references:
+                set_status(
+                    conn, prefix, accession, reference, IN_PROGRESS, job_id, index
+                )
+
+
+def parse_result_key(prefix, key):
+    """
+    Parse an output key of the form {prefix}/{accession}/{reference}/{accession}.sam.
+    Returns (accession, reference) or None if the key is not an output file.
+    """
+    segs = key[len(prefix) :].strip("/").split("/")
+    if len(segs) != 3 or segs[2] != "{}.sam".format(segs[0]):
+        return None
+    return segs[0], segs[1]
+
+
+def list_results(s3, bucket, prefix, accession=None):  # pylint: disable=invalid-name
+    """
+    yield (accession, reference) for every output object under prefix,
+    or only those for `accession` if given
+    """
+    listing = "{}/".format(prefix)
+    if accession:
+        listing = "{}{}/".format(listing, accession)
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=listing):
+        for item in page.get("Contents", []):
+            if item["Size"] == 0:
+                continue
+            parsed = parse_result_key(prefix, item["Key"])
+            if parsed:
+                yield parsed
+
+
+def sync_jobs(conn, batch):
+    """
+    Refresh the state of tracked jobs that have not yet finished.
+    Children that failed are marked as failed; once a job has finished,
+    anything it did not complete is no longer in flight. Jobs Batch no
+    longer knows about are marked EXPIRED.
+    """
+    job_ids = [
+        row[0]
+        for row in conn.execute(
+            "SELECT job_id FROM jobs WHERE status NOT IN (?, ?, ?)",
+            TERMINAL_JOB_STATES,
+        )
+    ]
+    for start in range(0, len(job_ids), 100):
+        chunk = job_ids[start : start + 100]
+        response = batch.describe_jobs(jobs=chunk)
+        returned = {x["jobId"] for x in response["jobs"]}
+        with conn:
+            for job_id in chunk:
+                if job_id not in returned:
+                    conn.execute(
+                        "UPDATE jobs SET status = ? WHERE job_id = ?",
+                        ("EXPIRED", job_id),
+                    )
+        for job in response["jobs"]:
+            with conn:
+                conn.execute(
+                    "UPDATE jobs SET status = ? WHERE job_id = ?",
+                    (job["status"], job["jobId"]),
+                )
+                failed = set()
+                if "arrayProperties" in job:
+                    paginator = batch.get_paginator("list_jobs")
+                    for page in paginator.paginate(
+                        arrayJobId=job["jobId"], jobStatus="FAILED"
+                    ):
+                        failed.update(
+                            x["arrayProperties"]["index"]
+                            for x in page["jobSummaryList"]
+                        )
+                elif job["status"] == "FAILED":
+                    failed.add(0)
+                for index in failed:
+                    conn.execute(
+                        "UPDATE pairs SET status = ?, updated = ? "
+                        "WHERE job_id = ? AND array_index = ? AND status = ?",
+                        (FAILED, now(), job["jobId"], index, IN_PROGRESS),
+                    )
+
+
+def read_manifest(s3, url):  # pylint: disable=invalid-name
+    "accession numbers in a submission manifest, in array index order"
+    parsed = urlparse(url)
+    obj = s3.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))
+    lines = obj["Body"].read().decode("utf-8").split("\n")
+    return [x.partition(SHARD_SEP)[0] for x in lines]
+
+
+def discover_jobs(conn, s3, batch, queue):  # pylint: disable=invalid-name
+    """
+    Start tracking unfinished jobs on `queue` that were not submitted
+    through the state store (e.g. by an older sra_pipeline).
+    """
+    tracked = {row[0] for row in conn.execute("SELECT job_id FROM jobs")}
+    job_ids = []
+    paginator = batch.get_paginator("list_jobs")
+    for state in ACTIVE_JOB_STATES:
+        for page in paginator.paginate(jobQueue=queue, jobStatus=state):
+            job_ids.extend(
+                x["jobId"] for x in page["jobSummaryList"] if x["jobId"] not in tracked
+            )
+    for start in range(0, len(job_ids), 100):
+        response = batch.describe_jobs(jobs=job_ids[start : start + 100])
+        for job in response["jobs"]:
+            env = {
+                x["name"]: x["value"]
+                for x in job.get("container", {}).get("environment", [])
+            }
+            if not all(x in env for x in ("ACCESSION_LIST", "PREFIX", "REFERENCES")):
+                continue
+            record_submission(
+                conn,
+                job["jobId"],
+                env["PREFIX"],
+                read_manifest(s3, env["ACCESSION_LIST"]),
+                [x.strip() for x in env["REFERENCES"].split(",")],
+            )
+
+
+def sync_results(conn, s3, bucket, prefix, full=False):  # pylint: disable=invalid-name
+    """
+    Mark pairs with output in S3 as completed. The first sync of a prefix
+    (or a `full` sync) lists the whole prefix; after that only accessions
+    with pairs still in flight are listed.
+    """
+    synced = conn.execute(
+        "SELECT 1 FROM synced_prefixes WHERE prefix = ?", (prefix,)
+    ).fetchone()
+    with conn:
+        if full or not synced:
+            for accession, reference in list_results(s3, bucket, prefix):
+                set_status(conn, prefix, accession, reference, COMPLETED)
+            conn.execute(
+                "INSERT OR REPLACE INTO synced_prefixes VALUES (?, ?)", (prefix, now())
+            )
+            return
+        accessions = [
+            row[0]
+            for row in conn.execute(
+                "SELECT DISTINCT accession FROM pairs WHERE prefix = ? AND status = ?",
+                (prefix, IN_PROGRESS),
+            )
+        ]
+        for accession in accessions:
+            for _, reference in list_results(s3, bucket, prefix, accession):
+                set_status(conn, prefix, accession, reference, COMPLETED)
+
+
+def expire_finished(conn):
+    "pairs still in flight for a job that has finished did not complete"
+    with conn:
+        conn.execute(
+            "UPDATE pairs SET status = ?, updated = ? WHERE status = ? AND job_id IN "
+            "(SELECT job_id FROM jobs WHERE status IN (?, ?, ?))",
+            (FAILED, now(), IN_PROGRESS) + TERMINAL_JOB_STATES,
+        )
+
+
+def sync_state(
+    conn, s3, batch, bucket, prefix, full=False, queue=None
+):  # pylint: disable=invalid-name,too-many-arguments
+    """
+    bring the state store up to date with Batch and S3,
+    picking up untracked jobs on `queue` if given
+    """
+    if queue:
+        discover_jobs(conn, s3, batch, queue)
+    sync_jobs(conn, batch)
+    sync_results(conn, s3, bucket, prefix, full)
+    expire_finished(conn)
+
+
+def missing_references(conn, prefix, accession_nums, references):
+    """
+    Return a dict mapping each accession to the references (in the order
+    given) that are neither completed nor in flight. Accessions with
+    nothing left to do map to an empty list.
+    """
+    missing = {}
+    for accession in accession_nums:
+        done = {
+            row[0]
+            for row in conn.execute(
+                "SELECT reference FROM pairs "
+                "WHERE prefix = ? AND accession = ? AND status IN (?, ?)",
+                (prefix, accession, COMPLETED, IN_PROGRESS),
+            )
+        }
+        missing[accession] = [x for x in references if x not in done]
+    return missing
+
+
+def status_counts(conn, prefix):
+    "return (status, count) pairs for prefix"
+    return conn.execute(
+        "SELECT status, COUNT(*) FROM pairs WHERE prefix = ? GROUP BY status "
+        "ORDER BY status",
+        (prefix,),
+    ).fetchall()
+
+
+def retry_attempts(conn, prefix, accession):
+    "number of times an accession has been resubmitted after failing"
+    row = conn.execute(
+        "SELECT attempts FROM retries WHERE prefix = ? AND accession = ?",
+        (prefix, accession),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def add_retry_attempt(conn, prefix, accession):
+    "count one more resubmission of an accession"
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO retries VALUES (?, ?, ?)",
+            (prefix, accession, retry_attempts(conn, prefix, accession) + 1),
+        )
@@ -0,0 +1,314 @@
+"tests for run.py"
+
+import hashlib
+import io
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import run
+
+
+class FakeStream:  # pylint: disable=too-few-public-methods
+    "stands in for a stream_to_s3() process"
+
+    def __init__(self):
+        self.stdin = io.BytesIO()
+
+    def lines(self):
+        "what was written, as lists of fields"
+        return [x.split("\t") for x in self.stdin.getvalue().decode().splitlines()]
+
+
+def record(
+    name, flag, rname, pos, score, rnext="=", pnext="1"
+):  # pylint: disable=too-many-arguments
+    "a SAM line from bowtie2 against the combined index"
+    return "\t".join(
+        [
+            name,
+            str(flag),
+            rname,
+            str(pos),
+            "1",
+            "4M",
+            rnext,
+            pnext,
+            "0",
+            "ACGT",
+            "IIII",
+            "AS:i:{}".format(score),
+        ]
+    )
+
+
+def pair(spot, rname, score, secondary=False):
+    "bowtie2 -k lines for one alignment of a pair with fastq-dump -I names"
+    extra = 0x100 if secondary else 0
+    return [
+        record("{}.1".format(spot), 99 | extra, rname, 10, score) + "\n",
+        record("{}.2".format(spot), 147 | extra, rname, 20, score) + "\n",
+    ]
+
+
+def demultiplex(lines):
+    "run group_records() and demultiplex_read() over lines as run_bowtie_combined() does"
+    streams = {"hhv6a": FakeStream(), "hhv6b": FakeStream()}
+    ambiguous = FakeStream()
+    tied = []
+    for item in run.group_records(lines):
+        if isinstance(item, str):
+            run.demultiplex_header(item, streams)
+        else:
+            tied.append(run.demultiplex_read(item, streams, ambiguous))
+    return streams, ambiguous, tied
+
+
+def test_read_key_drops_mate_number():
+    "mates named by fastq-dump -I belong to the same read"
+    assert run.read_key(["SRR1.7.1", "99"]) == "SRR1.7"
+    assert run.read_key(["SRR1.7.2{}3".format(run.DUP_SEP), "147"]) == "SRR1.7"
+    assert run.read_key(["SRR1.7.1", "0"]) == "SRR1.7.1"
+
+
+def test_mates_are_grouped_into_one_read():
+    "-k output interleaves mates; all of a pair's alignments are one group"
+    lines = (
+        ["@HD\tVN:1.0\n"]
+        + pair("SRR1.7", "hhv6b|NC_2", 8)
+        + pair("SRR1.7", "hhv6a|NC_1", 6, secondary=True)
+        + pair("SRR1.8", "hhv6a|NC_1", 8)
+    )
+    groups = list(run.group_records(lines))
+    assert groups[0] == "@HD\tVN:1.0\n"
+    assert [len(x) for x in groups[1:]] == [4, 2]
+
+
+def test_best_alignment_per_reference():
+    "each reference gets one pair, the best alignment to that reference"
+    lines = pair("SRR1.7", "hhv6b|NC_2", 8) + pair(
+        "SRR1.7", "hhv6a|NC_1", 6, secondary=True
+    )
+    streams, ambiguous, tied = demultiplex(lines)
+    assert tied == [None]
+    assert not ambiguous.lines()
+    hhv6b = streams["hhv6b"].lines()
+    assert [(x[0], x[1], x[2]) for x in hhv6b] == [
+        ("SRR1.7.1", "99", "NC_2"),
+        ("SRR1.7.2", "147", "NC_2"),
+    ]
+    hhv6a = streams["hhv6a"].lines()
+    assert [(x[0], x[1], x[2]) for x in hhv6a] == [
+        ("SRR1.7.1", "99", "NC_1"),
+        ("SRR1.7.2", "147", "NC_1"),
+    ]
+
+
+def test_tie_is_ambiguous():
+    "a pair scoring the same against both references is reported as ambiguous"
+    lines = pair("SRR1.7", "hhv6a|NC_1", 8) + pair(
+        "SRR1.7", "hhv6b|NC_2", 8, secondary=True
+    )
+    _, ambiguous, tied = demultiplex(lines)
+    assert tied == [("hhv6a", "hhv6b")]
+    assert ambiguous.lines() == [["SRR1.7.1", "16", "hhv6a,hhv6b"]]
+
+
+def test_header_names_every_reference():
+    "a combined index without sequences for a requested reference fails at @PG"
+    streams = {"hhv6a": FakeStream(), "hhv6b": FakeStream()}
+    header = [
+        "@HD\tVN:1.0\n",
+        "@SQ\tSN:hhv6a|NC_1\tLN:100\n",
+        "@PG\tID:bowtie2\n",
+    ]
+    try:
+        run.demultiplex_output(header + pair("SRR1.7", "hhv6a|NC_1", 8), streams, None)
+    except ValueError as exc:
+        assert "hhv6b" in str(exc)
+    else:
+        assert False, "missing reference not detected"
+    assert not [x for x in streams["hhv6a"].lines() if x[0].startswith("SRR")]
+
+    streams = {"hhv6a": FakeStream()}
+    counts = run.demultiplex_output(
+        header + pair("SRR1.7", "hhv6a|NC_1", 8), streams, FakeStream()
+    )
+    assert not counts
+    assert [x[0] for x in streams["hhv6a"].lines()] == [
+        "@HD",
+        "@SQ",
+        "@PG",
+        "SRR1.7.1",
+        "SRR1.7.2",
+    ]
+
+
+DATA = bytes(range(256)) * 40
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    serves DATA, honouring Range headers unless the server's `ranges` is
+    False, and records the ranges it was asked for in the server's `requested`
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        "serve (part of) DATA"
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            self.server.requested.append((start, end))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(DATA))
+            )
+        else:
+            start, end = 0, len(DATA) - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("ETag", '"{}"'.format(self.server.etag))
+        self.end_headers()
+        self.wfile.write(DATA[start : end + 1])
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        "keep test output quiet"
+
+
+def serve(etag=None, ranges=True):
+    "start a local server for DATA, returns it and its URL"
+    server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.etag = etag or hashlib.md5(DATA).hexdigest()
+    server.ranges = ranges
+    server.requested = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/SRR1.sra".format(server.server_port)
+
+
+def test_ranged_download(tmp_path):
+    "chunks are fetched concurrently into place and the checksum verified"
+    server, url = serve()
+    dest = str(tmp_path / "SRR1.sra")
+    try:
+        download = run.RangedDownload(url, dest, chunk_size=1000)
+        assert download.run(connections=4) == len(DATA)
+        download.verify()
+    finally:
+        server.shutdown()
+    with open(dest, "rb") as fileh:
+        assert fileh.read() == DATA
+    assert len(server.requested) == 1 + 11  # probe, then each chunk
+    assert not os.path.exists(download.resume_file)
+
+
+def test_ranged_download_resumes(tmp_path):
+    "chunks recorded in the resume map are not fetched again"
+    server, url = serve()
+    dest = str(tmp_path / "SRR1.sra")
+    with open(dest, "wb") as fileh:
+        fileh.write(DATA[:5000])
+    with open("{}.parts".format(dest), "w") as fileh:
+        json.dump(
+            dict(size=len(DATA), etag=server.etag, chunk_size=1000, done=[0, 2, 4]),
+            fileh,
+        )
+    try:
+        download = run.RangedDownload(url, dest, chunk_size=1000)
+        assert download.run(connections=2) == len(DATA) - 3000
+        download.verify()
+    finally:
+        server.shutdown()
+    with open(dest, "rb") as fileh:
+        assert fileh.read() == DATA
+    assert (0, 999) not in server.requested and (1000, 1999) in server.requested
+
+
+def test_ranged_download_mismatch(tmp_path):
+    "a checksum mismatch removes the download and resume map"
+    server, url = serve(etag=hashlib.md5(b"something else").hexdigest())
+    dest = str(tmp_path / "SRR1.sra")
+    try:
+        download = run.RangedDownload(url, dest, chunk_size=4096)
+        download.run()
+        try:
+            download.verify()
+        except ValueError as exc:
+            assert "md5" in str(exc)
+        else:
+            assert False, "mismatch not detected"
+    finally:
+        server.shutdown()
+    assert not os.path.exists(dest) and not os.path.exists(download.resume_file)
+
+
+def test_ranged_download_unsupported():
+    "a server that ignores Range is rejected, so prefetch can be used instead"
+    server, url = serve(ranges=False)
+    try:
+        try:
+            run.RangedDownload(url, "unused").probe()
+        except ValueError:
+            pass
+        else:
+            assert False, "server without range support accepted"
+    finally:
+        server.shutdown()
+
+
+def collapse(*mates):
+    """
+    run COLLAPSE_AWK over reads given as lists of (name, sequence) per
+    mate, in the order sort would give them, returning its output fastqs
+    """
+    lines = [
+        "\t".join(
+            "\t".join([name, seq, "+", "I" * len(seq)])
+            for name, seq in (x[i] for x in mates)
+        )
+        for i in range(len(mates[0]))
+    ]
+    proc = subprocess.run(
+        "awk -F '\\t' -v mates={} -v sep={} {} 3>&1 4>&2".format(
+            len(mates), run.DUP_SEP, shlex.quote(run.COLLAPSE_AWK)
+        ),
+        shell=True,
+        input="".join(x + "\n" for x in lines).encode(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    return (
+        proc.returncode,
+        {1: proc.stdout.decode().splitlines(), 2: proc.stderr.decode().splitlines()},
+    )
+
+
+def test_collapse_adjacent_duplicates():
+    "sorted copies of a pair become one pair, named with the number of copies"
+    status, outputs = collapse(
+        [("@r.1.1 r.1", "AAAA"), ("@r.3.1 r.3", "AAAA"), ("@r.2.1", "AAAA")],
+        [("@r.1.2 r.1", "CCCC"), ("@r.3.2 r.3", "CCCC"), ("@r.2.2", "GGGG")],
+    )
+    assert status == 0
+    # mate 1 and the counts share stdout; mate 2 is on stderr
+    assert outputs[1] == [
+        "@r.1.1__x2 r.1",
+        "AAAA",
+        "+",
+        "IIII",
+        "@r.2.1",
+        "AAAA",
+        "+",
+        "IIII",
+        "3 2",
+    ]
+    assert outputs[2][::4] == ["@r.1.2__x2 r.1", "@r.2.2"]
+
+
+def test_collapse_uneven_mates():
+    "a pair with a missing mate (paste pads it) stops the collapse"
+    status, _ = collapse([("@r.1.1", "AAAA"), ("", "")], [("@r.1.2", "CC")] * 2)
+    assert status == 3
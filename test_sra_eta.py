@@ -0,0 +1,45 @@
+"tests for predicting job run times in sra_eta.py"
+
+import sra_eta
+
+# one second per stage, whatever the size
+MODEL = {
+    x: [0.0, 1.0, 0.0, 10]
+    for x in ["download", "fastq-dump", "bgzf", "fastq-cache", "collapse", "bowtie2"]
+}
+ENV = dict(REFERENCES="hhv6a,hhv6b", NUM_CORES="4")
+
+
+def test_stages_depend_on_cache_and_collapsing():
+    "cached accessions skip making fastqs; collapsing only counts if asked for"
+    assert sra_eta.predict(MODEL, 1e9, ENV) == 3 + 2
+    assert sra_eta.predict(MODEL, 1e9, ENV, cached=True) == 1 + 2
+    collapsing = dict(ENV, COLLAPSE_DUPLICATES="True")
+    assert sra_eta.predict(MODEL, 1e9, collapsing, cached=True) == 2 + 2
+
+
+def test_combined_index():
+    "with a combined index bowtie2 is counted once"
+    assert sra_eta.predict(MODEL, 1e9, dict(ENV, COMBINED_INDEX="hhv6"), True) == 2
+
+
+def test_job_eta():
+    "running children count what is left of their prediction; stragglers are listed"
+    job = {
+        "container": {"environment": [{"name": x, "value": y} for x, y in ENV.items()]}
+    }
+    children = [
+        {"arrayProperties": {"index": 0}, "status": "RUNNING", "startedAt": 0},
+        {"arrayProperties": {"index": 1}, "status": "RUNNING", "startedAt": 2000},
+        {"arrayProperties": {"index": 2}, "status": "RUNNABLE"},
+    ]
+    accessions = [
+        dict(line="SRR1", size=1e9, cached=False),
+        dict(line="SRR2#0/2", size=5e8, cached=True),
+        dict(line="SRR3", size=1e9, cached=True),
+    ]
+    eta = sra_eta.job_eta(MODEL, job, children, accessions, now=12)
+    assert eta["running"] == 2 and eta["waiting"] == 1
+    assert eta["remaining_child_hours"] == (0 + 0 + 3) / 3600
+    assert eta["remaining_vcpu_hours"] == 4 * 3 / 3600
+    assert eta["stragglers"] == [(0, "SRR1", 12, 5), (1, "SRR2#0/2", 10, 3)]
@@ -0,0 +1,79 @@
+"tests for classifying failed children in sra_retry.py"
+
+import sra_retry
+
+
+class FakeLogs:  # pylint: disable=too-few-public-methods
+    "stands in for a CloudWatch Logs client; `streams` maps stream names to messages"
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def get_log_events(self, **kwargs):
+        "the messages in a log stream"
+        return {
+            "events": [{"message": x} for x in self.streams[kwargs["logStreamName"]]]
+        }
+
+
+def child(exit_code=1, reason="", status_reason="Essential container in task exited"):
+    "a failed child's job description"
+    return {
+        "statusReason": status_reason,
+        "container": {"exitCode": exit_code, "reason": reason},
+    }
+
+
+def test_spot_reclaim():
+    "a child whose instance went away is a spot failure, whatever it logged"
+    reclaimed = child(
+        status_reason="Host EC2 (instance i-0123) terminated.", exit_code=None
+    )
+    assert sra_retry.classify(reclaimed, ["std::bad_alloc"]) == sra_retry.SPOT
+
+
+def test_dependency():
+    "a child that never ran because a job it depended on failed can be retried"
+    never_ran = {"statusReason": "Dependent Job failed"}
+    assert sra_retry.classify(never_ran, []) == sra_retry.DEPENDENCY
+    assert sra_retry.DEPENDENCY in sra_retry.RETRYABLE
+
+
+def test_out_of_memory():
+    "Batch's OOM reason, an allocation failure or SIGKILL are all OOM"
+    assert (
+        sra_retry.classify(child(reason="OutOfMemoryError: Container killed"), [])
+        == sra_retry.OOM
+    )
+    assert sra_retry.classify(child(), ["terminate called: std::bad_alloc"]) == (
+        sra_retry.OOM
+    )
+    assert sra_retry.classify(child(exit_code=137), []) == sra_retry.OOM
+
+
+def test_log_signatures():
+    "log messages are matched in LOG_SIGNATURES order"
+    messages = [
+        "prefetch exited with nonzero result-code 3",
+        "Error, fewer reads in file specified with -2 than in file specified with -1",
+    ]
+    assert sra_retry.classify(child(), messages) == sra_retry.PREFETCH
+    assert sra_retry.classify(child(), messages[1:]) == sra_retry.MATE_MISMATCH
+    assert sra_retry.classify(child(), ["ranged download failed"]) == (
+        sra_retry.PREFETCH
+    )
+
+
+def test_unknown():
+    "anything else is not retried"
+    assert sra_retry.classify(child(), ["Traceback"]) == sra_retry.UNKNOWN
+    assert sra_retry.UNKNOWN not in sra_retry.RETRYABLE
+
+
+def test_job_that_is_not_an_array_job():
+    "a single-child job is classified as its own child at index 0"
+    job = dict(child(exit_code=137), jobId="job1")
+    job["container"]["logStreamName"] = "stream"
+    logs = FakeLogs({"stream": ["aligning"]})
+    assert sra_retry.classify_failures(None, logs, job, [0]) == {0: sra_retry.OOM}
+    assert sra_retry.classify_failures(None, logs, job, []) == {}
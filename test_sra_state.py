@@ -0,0 +1,175 @@
+"tests for the local state store in sra_state.py"
+
+import io
+
+import sra_state
+
+PREFIX = "pipeline-results"
+BUCKET = "bucket"
+
+
+class FakePaginator:  # pylint: disable=too-few-public-methods
+    "stands in for a boto3 paginator, returning a single page"
+
+    def __init__(self, page):
+        self.page = page
+
+    def paginate(self, **kwargs):
+        "one page of results for the given arguments"
+        yield self.page(**kwargs)
+
+
+class FakeS3:
+    "stands in for an S3 client holding `objects` (key -> body)"
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, _):
+        "a list_objects_v2 paginator"
+        return FakePaginator(
+            lambda Bucket, Prefix: {
+                "Contents": [
+                    {"Key": x, "Size": len(y)}
+                    for x, y in sorted(self.objects.items())
+                    if x.startswith(Prefix)
+                ]
+            }
+        )
+
+    def get_object(self, Bucket, Key):  # pylint: disable=invalid-name,unused-argument
+        "an object's body"
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+class FakeBatch:
+    """
+    stands in for a Batch client; `jobs` maps job ids to descriptions and
+    `failed` maps array job ids to the indices of failed children
+    """
+
+    def __init__(self, jobs, failed=None):
+        self.jobs = jobs
+        self.failed = failed or {}
+
+    def describe_jobs(self, jobs):
+        "descriptions of the jobs Batch still knows about"
+        return {"jobs": [self.jobs[x] for x in jobs if x in self.jobs]}
+
+    def get_paginator(self, _):
+        "a list_jobs paginator"
+
+        def page(
+            arrayJobId=None, jobStatus=None, jobQueue=None
+        ):  # pylint: disable=invalid-name
+            if arrayJobId:
+                return {
+                    "jobSummaryList": [
+                        {"jobId": arrayJobId, "arrayProperties": {"index": x}}
+                        for x in self.failed.get(arrayJobId, [])
+                    ]
+                }
+            return {
+                "jobSummaryList": [
+                    {"jobId": x}
+                    for x, y in self.jobs.items()
+                    if y["status"] == jobStatus and jobQueue
+                ]
+            }
+
+        return FakePaginator(page)
+
+
+def result(accession, reference):
+    "the S3 key and body of an alignment result"
+    return "{}/{}/{}/{}.sam".format(PREFIX, accession, reference, accession), b"@HD"
+
+
+def statuses(conn):
+    "(accession, reference) -> status for every pair"
+    return {
+        (x[0], x[1]): x[2]
+        for x in conn.execute("SELECT accession, reference, status FROM pairs")
+    }
+
+
+def test_parse_result_key():
+    "only {prefix}/{acc}/{ref}/{acc}.sam keys are results"
+    assert sra_state.parse_result_key(PREFIX, result("SRR1", "hhv6a")[0]) == (
+        "SRR1",
+        "hhv6a",
+    )
+    assert sra_state.parse_result_key(PREFIX, PREFIX + "/SRR1/hhv6a/SRR2.sam") is None
+    assert sra_state.parse_result_key(PREFIX, PREFIX + "/SRR1/SRR1.sam") is None
+
+
+def test_partial_references():
+    "a finished job that produced only some references leaves the rest to do"
+    conn = sra_state.open_state(":memory:")
+    sra_state.record_submission(conn, "job1", PREFIX, ["SRR1"], ["hhv6a", "hhv6b"])
+    s3 = FakeS3(dict([result("SRR1", "hhv6a")]))  # pylint: disable=invalid-name
+    batch = FakeBatch({"job1": {"jobId": "job1", "status": "SUCCEEDED"}})
+    sra_state.sync_state(conn, s3, batch, BUCKET, PREFIX)
+    assert statuses(conn) == {
+        ("SRR1", "hhv6a"): sra_state.COMPLETED,
+        ("SRR1", "hhv6b"): sra_state.FAILED,
+    }
+    assert sra_state.missing_references(
+        conn, PREFIX, ["SRR1", "SRR2"], ["hhv6a", "hhv6b"]
+    ) == {"SRR1": ["hhv6b"], "SRR2": ["hhv6a", "hhv6b"]}
+
+
+def test_expired_job():
+    "a job Batch no longer describes is finished, and its pairs are not in flight"
+    conn = sra_state.open_state(":memory:")
+    sra_state.record_submission(conn, "job1", PREFIX, ["SRR1"], ["hhv6a"])
+    sra_state.sync_state(conn, FakeS3({}), FakeBatch({}), BUCKET, PREFIX)
+    assert conn.execute("SELECT status FROM jobs").fetchall() == [("EXPIRED",)]
+    assert statuses(conn) == {("SRR1", "hhv6a"): sra_state.FAILED}
+    assert sra_state.missing_references(conn, PREFIX, ["SRR1"], ["hhv6a"]) == {
+        "SRR1": ["hhv6a"]
+    }
+
+
+def test_failed_children():
+    "failed children of a running array job are failed; the rest stay in flight"
+    conn = sra_state.open_state(":memory:")
+    sra_state.record_submission(conn, "job1", PREFIX, ["SRR1", "SRR2"], ["hhv6a"])
+    batch = FakeBatch(
+        {"job1": {"jobId": "job1", "status": "RUNNING", "arrayProperties": {}}},
+        failed={"job1": [1]},
+    )
+    sra_state.sync_state(conn, FakeS3({}), batch, BUCKET, PREFIX)
+    assert statuses(conn) == {
+        ("SRR1", "hhv6a"): sra_state.IN_PROGRESS,
+        ("SRR2", "hhv6a"): sra_state.FAILED,
+    }
+
+
+def test_discovered_shard_lines():
+    "an untracked job's shard lines are recorded against their accession"
+    conn = sra_state.open_state(":memory:")
+    manifest = "s3://{}/sra-submission-manifests/1-3.txt".format(BUCKET)
+    s3 = FakeS3(  # pylint: disable=invalid-name
+        {"sra-submission-manifests/1-3.txt": b"SRR1#0/2\nSRR1#1/2\nSRR2"}
+    )
+    env = dict(ACCESSION_LIST=manifest, PREFIX=PREFIX, REFERENCES="hhv6a, hhv6b")
+    batch = FakeBatch(
+        {
+            "job1": {
+                "jobId": "job1",
+                "status": "RUNNING",
+                "container": {
+                    "environment": [{"name": x, "value": y} for x, y in env.items()]
+                },
+            }
+        }
+    )
+    sra_state.sync_state(conn, s3, batch, BUCKET, PREFIX, queue="mixed")
+    assert set(statuses(conn)) == {
+        ("SRR1", "hhv6a"),
+        ("SRR1", "hhv6b"),
+        ("SRR2", "hhv6a"),
+        ("SRR2", "hhv6b"),
+    }
+    assert set(statuses(conn).values()) == {sra_state.IN_PROGRESS}